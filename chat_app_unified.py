@@ -8,27 +8,43 @@ Features added:
 - GUI menu: clear history, keep last N messages, keep last X days
 - Logging to app.log (no silent excepts)
 - Optional shared-key "encryption" (XOR + HMAC) for message payloads (NOT TLS; see warnings)
-- ping/pong protocol uses JSON responses: {"pong":1,"rtt_ms":123}
+- ping/pong uses a 9-byte binary heartbeat (opcode + echoed timestamp)
+- Requires Python 3.10+ (history pruning uses bisect with key=)
 """
 
 
 # ماژول‌های مورد نیاز برای عملکردهای مختلف برنامه
-import socket, threading, json, os, time, platform, logging, hashlib
+import socket, threading, json, os, sys, time, platform, logging, logging.handlers, hashlib, hmac, struct, select, selectors, collections, contextlib, atexit, bisect, tempfile, stat
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 import tkinter as tk
 from tkinter import messagebox, simpledialog, scrolledtext
 from datetime import datetime, timedelta
 
+# orjson در صورت نصب بودن استفاده می‌شود (سریع‌تر از json استاندارد)، وگرنه json معمولی
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numpy اختیاری است؛ فقط برای XOR پیام‌های بزرگ (XOR_NUMPY_MIN_SIZE به بالا) استفاده می‌شود
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 tk.Font = ("Arial", 11)
 
 
-# بررسی سیستم‌عامل؛ اگر ویندوز بود، ماژول winsound برای پخش صدای اعلان وارد می‌شود
-if platform.system() == "Windows":
+# بررسی سیستم‌عامل (یک بار)؛ اگر ویندوز بود، ماژول winsound برای پخش صدای اعلان وارد می‌شود
+_IS_WINDOWS = platform.system() == "Windows"
+if _IS_WINDOWS:
     import winsound  # For notification sound
 
 # ------------------- Configuration -------------------
 # نام فایل‌هایی که برای ذخیره داده‌ها استفاده می‌شوند
-HISTORY_FILE = "chat_history.json"    # فایل ذخیره تاریخچه پیام‌ها
+HISTORY_FILE = "chat_history.json"    # فایل ذخیره تاریخچه پیام‌ها (snapshot کامل)
+HISTORY_JOURNAL_FILE = "chat_history.jsonl"    # رکوردهای جدید بعد از آخرین snapshot (فقط append)
 PORT_FILE = f"listen_port_{socket.gethostname()}.txt"       # فایل ذخیره پورت شنود
 LOG_FILE = "app.log"   
 PEERS_FILE = "peers.json"
@@ -37,25 +53,102 @@ PEERS_FILE = "peers.json"
 # حداکثر تعداد رکوردهای پینگ ذخیره‌شده برای هر کاربر
 MAX_PING_RECORDS_PER_PEER = 300
 
+# پیام‌های کوتاه‌تر از این طول (مثل "ok"، "سلام") در حافظه فقط یک نسخه دارند (sys.intern)
+INTERN_MSG_MAX_LEN = 64
+
+# تعداد نمونه‌هایی از لیست هر همتا که قبل از جست‌وجوی دودویی زمان، برای مرتب بودن بررسی می‌شوند
+HISTORY_SORT_SAMPLES = 32
+
+# حداکثر تعداد کل رکوردهای نگه‌داشته‌شده برای هر همتا؛ قدیمی‌ترین‌ها هنگام افزودن حذف می‌شوند
+MAX_HISTORY_RECORDS_PER_PEER = 1000
+# رکوردهای اضافه تا این تعداد جمع و بعد یک‌جا از ابتدای لیست حذف می‌شوند
+HISTORY_TRIM_SLACK = 64
+
+# بعد از این تعداد رکورد در journal، snapshot کامل نوشته و journal خالی می‌شود
+HISTORY_JOURNAL_MAX_RECORDS = 2000
+
+# اگر رکوردهای حذف‌شده با keep_last_n/keep_last_days (که هنوز در snapshot هستند) از این نسبت
+# تاریخچه‌ی باقی‌مانده بیشتر شوند، snapshot در پس‌زمینه بازنویسی می‌شود
+HISTORY_COMPACT_PRUNED_RATIO = 0.3
+
+# رکوردهای journal در بافر جمع و هر چند ثانیه یک بار با هم روی دیسک نوشته می‌شوند
+HISTORY_FLUSH_INTERVAL = 1.0
+
+# دوام فایل‌های snapshot: محتوای فایل موقت همیشه قبل از os.replace با fsync روی دیسک می‌رود؛
+# در حالت "strict" پوشه هم بعد از replace با fsync ثبت می‌شود (یک fsync بیشتر برای هر ذخیره)
+HISTORY_DURABILITY = "normal"
+
 # کلید اشتراکی اختیاری برای رمزنگاری ساده (XOR + HMAC)
 # اگر مقدار خالی باشد رمزنگاری انجام نمی‌شود
 # ⚠️ هشدار: این روش امنیت کامل TLS را ندارد و فقط برای جلوگیری از شنود ساده در LAN کاربرد دارد
 SHARED_KEY = ""  # مثال: "mysecretkey"
 
+# پیام‌های رمز شده از این اندازه (بایت) به بالا در صورت نصب بودن numpy با آن XOR می‌شوند
+XOR_NUMPY_MIN_SIZE = 4096
+
 # بازه زمانی بین چک کردن آنلاین بودن همتایان (برحسب ثانیه)
 CHECK_INTERVAL = 5
+
+# مدت اعتبار IP محلی cache شده (ثانیه)
+LOCAL_IP_CACHE_TTL = 30
+
+# مدت انتظار برای پاسخ پینگ‌های UDP در هر دور بررسی (ثانیه)
+UDP_PING_TIMEOUT = 1.0
+# حداکثر زمان اتصال و انتظار پونگ در پینگ TCP (ثانیه)؛ همتای خاموش worker را بیشتر از این نگه نمی‌دارد
+TCP_PING_TIMEOUT = 1.5
+
+# اتصال‌های خروجی به همتایان بین پیام‌ها باز می‌مانند؛ بعد از این مدت بیکاری (ثانیه) بسته می‌شوند
+PEER_CONN_IDLE_TIMEOUT = 60
+
+# پخش صدای اعلان برای پیام‌های جدید
+NOTIFY_SOUND_ENABLED = True
+# حداقل فاصله‌ی دو صدای اعلان برای یک همتا (ثانیه)
+NOTIFY_SOUND_MIN_INTERVAL = 0.3
+# پیام‌های دریافتی پشت سر هم از یک همتا در این بازه (ثانیه) زیر یک زمان نمایش داده می‌شوند
+BUBBLE_COALESCE_SECONDS = 1.0
+
+# تعداد پیام‌هایی از تاریخچه که هنگام باز شدن پنجره چت نمایش داده می‌شوند؛
+# پیام‌های قدیمی‌تر با رسیدن اسکرول به بالا، به همین تعداد اضافه می‌شوند
+CHAT_HISTORY_PAGE = 200
+
+# رفرش‌های درخواست‌شده‌ی لیست همتایان در این بازه (میلی‌ثانیه) در یک رفرش جمع می‌شوند
+REFRESH_DEBOUNCE_MS = 100
+
+# حداکثر تعداد پینگ‌های TCP هم‌زمان در هر دور بررسی (برای همتایانی که به UDP پاسخ نداده‌اند)
+MAX_PARALLEL_PINGS = 32
+
+# حداکثر اندازه‌ی مجاز یک فریم دریافتی (بایت)
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+# اندازه‌ی بافر ارسال/دریافت سوکت‌های TCP (بایت)؛ برای پیام‌های پشت سر هم و فایل‌های بزرگ‌تر
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# حداکثر تعداد همتایانی که خودکار (با پیام/پینگ دریافتی) به لیست اضافه می‌شوند؛
+# در صورت پر بودن، همتایی که مدت بیشتری دیده نشده حذف می‌شود
+MAX_PEERS = 256
+
+# تغییرات لیست همتایان حداکثر با این تأخیر (ثانیه) و در یک نوشتن روی دیسک ذخیره می‌شوند
+PEERS_SAVE_DELAY = 1.0
+
+# سطح لاگ برنامه؛ با logging.INFO لاگ‌های debug مسیرهای پرتکرار (پینگ/پیام) اصلاً ساخته نمی‌شوند
+LOG_LEVEL = logging.DEBUG
+# رکوردهای لاگ فایل تا این تعداد در حافظه جمع و یک‌جا نوشته می‌شوند (WARNING به بالا فوراً)
+LOG_BUFFER_RECORDS = 1024
 # ----------------- End Configuration ------------------
 
 # تنظیمات سیستم لاگ‌گیری برنامه
 logger = logging.getLogger("p2pchat")        # ساخت logger مخصوص برنامه
-logger.setLevel(logging.DEBUG)              # تعیین سطح لاگ (ثبت همه سطح‌ها)
+logger.setLevel(LOG_LEVEL)                  # تعیین سطح لاگ (پیش‌فرض: ثبت همه سطح‌ها)
 
 # ساخت و افزودن FileHandler برای نوشتن لاگ در فایل
 fh = logging.FileHandler(LOG_FILE, encoding="utf-8")
 fh.setLevel(logging.DEBUG)
 fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")  # قالب‌بندی پیام لاگ
 fh.setFormatter(fmt)
-logger.addHandler(fh)
+# FileHandler پشت MemoryHandler قرار می‌گیرد تا هر رکورد یک write جدا نداشته باشد؛
+# بافر با پر شدن، با هر WARNING، به‌صورت دوره‌ای در history_flusher و هنگام خروج خالی می‌شود
+log_buffer = logging.handlers.MemoryHandler(LOG_BUFFER_RECORDS, flushLevel=logging.WARNING, target=fh)
+logger.addHandler(log_buffer)
 
 # ساخت و افزودن StreamHandler برای نمایش لاگ در کنسول
 ch = logging.StreamHandler()
@@ -63,29 +156,348 @@ ch.setLevel(logging.WARNING)
 ch.setFormatter(fmt)
 logger.addHandler(ch)
 
+# توابع کمکی JSON: خروجی _dumps همیشه bytes است و _loads ورودی bytes/bytearray/memoryview می‌گیرد
+if orjson is not None:
+    def _dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    _loads = orjson.loads
+else:
+    def _dumps(obj, indent=False):
+        return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+    def _loads(data):
+        # json.loads استاندارد memoryview نمی‌پذیرد
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
 # تابع ساده برای برگرداندن زمان فعلی به صورت رشته‌ای
+# رشته‌ی زمان فقط یک بار در هر ثانیه ساخته می‌شود: (ثانیه‌ی epoch، رشته)
+_now_cache = (0, "")
+
+
 def now():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    global _now_cache
+    sec = int(time.time())
+    cached = _now_cache
+    if cached[0] == sec:
+        return cached[1]
+    # time.strftime مستقیم روی struct_time بدون ساختن شیء datetime
+    text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))
+    # جایگزینی tuple کامل اتمیک است، پس قفل لازم نیست
+    _now_cache = (sec, text)
+    return text
+
+# قفل سراسری تاریخچه: فقط برای عملیات روی کل تاریخچه (snapshot، پاکسازی) همراه با همه‌ی قفل‌های همتا
+history_lock = threading.RLock()
+
+# قفل‌های همتا به صورت striped: هر همتا با hash خود به یکی از _PEER_LOCK_STRIPES قفل ثابت نگاشت می‌شود،
+# پس ثبت رکورد همتاهای مختلف هم‌زمان انجام می‌شود و حتی همتای جدید هم history_lock را نمی‌گیرد.
+# ترتیب گرفتن قفل‌ها همیشه: history_lock ← قفل‌های همتا (به ترتیب اندیس) ← _journal_lock
+_PEER_LOCK_STRIPES = 64
+_peer_locks = [threading.Lock() for _ in range(_PEER_LOCK_STRIPES)]
+
+
+def _peer_lock(peer):
+    """قفل stripe مربوط به یک همتا"""
+    return _peer_locks[hash(peer) & (_PEER_LOCK_STRIPES - 1)]
+
+# قفل نوشتن در فایل journal و شمارنده‌ی آن
+_journal_lock = threading.Lock()
+
+# فایل journal تاریخچه یک بار باز می‌شود و رکوردها فقط به انتهای آن اضافه می‌شوند
+_journal_fh = None
+# خط‌های journal که هنوز در فایل نوشته نشده‌اند؛ thread های پیام فقط به این لیست اضافه می‌کنند
+# و نوشتن (یک write برای همه) در flush_history_journal انجام می‌شود
+_journal_pending = []
+_journal_records = 0    # تعداد رکوردهای journal از آخرین snapshot
+_pruned_records = 0     # تعداد رکوردهایی که با عملیات حذف journal از حافظه حذف شده‌اند ولی در snapshot مانده‌اند
+# شماره‌ی آخرین save_history (زیر _journal_lock)؛ snapshot پس‌زمینه‌ای که از آن عقب بماند دور ریخته می‌شود
+_snapshot_gen = 0
+# شماره‌ی ترتیبی آخرین رکورد journal (زیر _journal_lock)؛ هر خط journal شماره‌ی خودش ("s") را دارد و
+# snapshot شماره‌ی آخرین رکوردی را که در بر دارد ذخیره می‌کند، تا replay رکوردهای داخل snapshot را دوباره اعمال نکند
+_journal_seq = 0
+# hash محتوای snapshot فعلی روی دیسک (زیر _journal_lock)؛ snapshot با محتوای یکسان دوباره نوشته نمی‌شود
+_snapshot_hash = None
+# وقتی journal به HISTORY_JOURNAL_MAX_RECORDS برسد (یا حذف‌ها از HISTORY_COMPACT_PRUNED_RATIO بگذرند)
+# set می‌شود تا history_flusher فشرده‌سازی را انجام دهد
+history_compact_needed = threading.Event()
+
+
+def _intern_entry(entry):
+    """
+    یکسان‌سازی رشته‌های تکراری یک رکورد در حافظه: "dir" و "type" و پیام‌های کوتاه
+    بعد از بارگذاری هر بار یک شیء جدا هستند؛ با sys.intern همه به یک نسخه اشاره می‌کنند.
+    قالب فایل تغییری نمی‌کند.
+    """
+    for field in ("dir", "type"):
+        value = entry.get(field)
+        if type(value) is str:
+            entry[field] = sys.intern(value)
+    msg = entry.get("msg")
+    if type(msg) is str and len(msg) <= INTERN_MSG_MAX_LEN:
+        entry["msg"] = sys.intern(msg)
+
+
+def _append_entry(hist, peer, entry):
+    """
+    افزودن یک رکورد به لیست یک همتا در dict تاریخچه.
+    برای رکوردهای "ping" تعداد پینگ‌های هر همتا به MAX_PING_RECORDS_PER_PEER محدود می‌شود.
+    کل لیست هم به MAX_HISTORY_RECORDS_PER_PEER محدود است (حذف گروهی با HISTORY_TRIM_SLACK)،
+    پس هزینه‌ی حذف بین افزودن‌ها پخش می‌شود و keep_last_n برای همتاهای کوچک‌تر کاری ندارد.
+    """
+    _intern_entry(entry)
+    lst = hist.setdefault(peer, [])
+    lst.append(entry)
+    if len(lst) > MAX_HISTORY_RECORDS_PER_PEER + HISTORY_TRIM_SLACK:
+        del lst[:len(lst) - MAX_HISTORY_RECORDS_PER_PEER]
+    if entry.get("type") == "ping":
+        pings = [i for i in lst if i.get("type") == "ping"]
+        if len(pings) > MAX_PING_RECORDS_PER_PEER:
+            # حذف قدیمی‌ترین پینگ‌ها و نگه‌داشتن جدیدها
+            remove_count = len(pings) - MAX_PING_RECORDS_PER_PEER
+            new_lst = []
+            removed = 0
+            for it in lst:
+                if it.get("type") == "ping" and removed < remove_count:
+                    removed += 1
+                    continue
+                new_lst.append(it)
+            hist[peer] = new_lst
+
+
+def _entry_time(entry):
+    """زمان رکورد به صورت رشته‌ی قابل مقایسه (رکورد بدون زمان قدیمی‌ترین حساب می‌شود)"""
+    return entry.get("time") or ""
+
+
+def _looks_time_sorted(lst):
+    """
+    بررسی نمونه‌ای مرتب بودن لیست بر اساس زمان (HISTORY_SORT_SAMPLES رکورد با فاصله‌ی مساوی و رکورد آخر).
+    لیست‌ها به ترتیب دریافت اضافه می‌شوند، ولی جابه‌جایی ساعت سیستم می‌تواند ترتیب را به هم بزند.
+    """
+    n = len(lst)
+    prev = ""
+    for i in range(0, n, max(1, n // HISTORY_SORT_SAMPLES)):
+        t = _entry_time(lst[i])
+        if t < prev:
+            return False
+        prev = t
+    return not n or _entry_time(lst[-1]) >= prev
+
+
+def _drop_before(lst, cutoff_str):
+    """
+    حذف درجای رکوردهای قبل از cutoff_str (یا بدون زمان) از لیست یک همتا؛ خروجی: تعداد حذف‌شده.
+    لیست مرتب با جست‌وجوی دودویی بریده می‌شود و لیست نامرتب با یک پیمایش کامل فیلتر می‌شود.
+    """
+    if _looks_time_sorted(lst):
+        idx = bisect.bisect_left(lst, cutoff_str, key=_entry_time)
+        del lst[:idx]
+        return idx
+    kept = [e for e in lst if _entry_time(e) >= cutoff_str]
+    removed = len(lst) - len(kept)
+    if removed:
+        lst[:] = kept
+    return removed
+
+
+def apply_history_op(hist, op):
+    """
+    اعمال یک عملیات حذف {"op": "keep", "n": N, "cutoff": "%Y-%m-%d %H:%M:%S"} روی dict تاریخچه؛
+    هم هنگام اجرا و هم هنگام replay journal صدا زده می‌شود. هر دو کلید اختیاری‌اند و در یک پیمایش هر همتا اعمال می‌شوند:
+    - cutoff: رکوردهای قبل از cutoff (یا بدون زمان) حذف می‌شوند
+    - n: فقط N رکورد آخر هر همتا نگه داشته می‌شود
+    خروجی: تعداد رکوردهای حذف‌شده
+    """
+    if op.get("op") != "keep":
+        raise ValueError("Unknown history op: %r" % (op.get("op"),))
+    n, cutoff_str = op.get("n"), op.get("cutoff")
+    removed = 0
+    for peer, lst in hist.items():
+        # حذف درجا تا لیست همتا همان شیء قبلی بماند
+        dropped = _drop_before(lst, cutoff_str) if cutoff_str is not None else 0
+        if n is not None and len(lst) > n:
+            # فقط N پیام آخر نگه داشته می‌شود (حذف درجا، بدون ساخت لیست جدید)
+            dropped += len(lst) - n
+            del lst[:len(lst) - n]
+        if dropped:
+            removed += dropped
+    return removed
+
+
+@contextlib.contextmanager
+def history_exclusive():
+    """گرفتن history_lock و همه‌ی قفل‌های همتا برای عملیاتی که کل تاریخچه را می‌خوانند یا تغییر می‌دهند"""
+    with history_lock:
+        for lock in _peer_locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(_peer_locks):
+                lock.release()
+
+
+def get_peer_history(peer):
+    """کپی رکوردهای یک همتا؛ فقط قفل همان همتا گرفته می‌شود"""
+    with _peer_lock(peer):
+        return list(history.get(peer, ()))
+
+
+# snapshot به صورت {"seq": N, "history": {...}} نوشته می‌شود؛ N شماره‌ی آخرین رکورد journal داخل آن است.
+# پیشوند ثابت است تا hash فقط روی بخش تاریخچه حساب شود و seq تازه، snapshot بدون تغییر را دوباره ننویسد
+_SNAPSHOT_PREFIX = b'{"seq":%d,"history":'
+
+
+def _snapshot_bytes(seq, data):
+    """ساخت محتوای فایل snapshot از JSON تاریخچه (data) و شماره‌ی آخرین رکورد journal داخل آن"""
+    return b"".join((_SNAPSHOT_PREFIX % seq, data, b"}"))
+
+
+def _parse_snapshot(raw):
+    """
+    خواندن فایل snapshot؛ فایل نسخه‌های قبلی (فقط dict تاریخچه) با seq صفر خوانده می‌شود.
+    خروجی: (تاریخچه، seq، بایت‌های JSON تاریخچه برای hash)
+    """
+    obj = _loads(raw)
+    # کلیدهای تاریخچه آدرس IP هستند، پس "seq" و "history" فقط در قالب جدید وجود دارند
+    if type(obj.get("seq")) is int and "history" in obj:
+        seq = obj["seq"]
+        prefix = _SNAPSHOT_PREFIX % seq
+        body = raw[len(prefix):-1] if raw.startswith(prefix) else _dumps(obj["history"])
+        return obj["history"], seq, body
+    return obj, 0, raw
 
-# قفل thread برای کنترل دسترسی هم‌زمان به تاریخچه
-history_lock = threading.Lock()
 
 # تابع برای بارگذاری تاریخچه از فایل
-def load_history():
+def load_history(max_age_days=None):
+    """
+    بارگذاری snapshot تاریخچه و سپس اعمال رکوردهای journal روی آن.
+    خط‌های خراب journal (مثلاً خط نیمه‌کاره بعد از crash) نادیده گرفته می‌شوند.
+    رکوردهایی که شماره‌شان از seq snapshot بیشتر نباشد قبلاً در snapshot هستند و اعمال نمی‌شوند
+    (crash بعد از نوشتن snapshot و قبل از کوتاه شدن journal).
+    اگر max_age_days داده شود، رکوردهای قدیمی‌تر (یا بدون زمان) در همین مرحله کنار گذاشته می‌شوند.
+    خروجی: (تاریخچه، آیا رکوردی حذف شد)
+    """
+    global _journal_records, _snapshot_hash, _journal_seq
+    hist = {}
+    snap_seq = 0
+    cleaned = False
+    cutoff_str = None
+    if max_age_days is not None:
+        # زمان مرجع حذف به صورت رشته؛ قالب "%Y-%m-%d %H:%M:%S" به ترتیب زمانی قابل مقایسه‌ی رشته‌ای است
+        cutoff_str = (datetime.now() - timedelta(days=max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+
     if os.path.exists(HISTORY_FILE):    # بررسی وجود فایل تاریخچه
         try:
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)     # خواندن داده JSON و برگرداندن به صورت dict
+            with open(HISTORY_FILE, "rb") as f:
+                raw = f.read()
+            hist, snap_seq, body = _parse_snapshot(raw)     # خواندن داده JSON و برگرداندن به صورت dict
+            _snapshot_hash = _content_hash(body)
         except Exception as e:
             logger.exception("Failed to load history file")
-    return {}  # اگر فایل نبود یا خطا داد، تاریخچه خالی برمی‌گرداند
+
+    if cutoff_str is not None:
+        # فیلتر در همان پیمایش بارگذاری، قبل از replay رکوردهای journal
+        for peer, lst in hist.items():
+            # لیست هر همتا معمولاً به ترتیب زمان است و با جست‌وجوی دودویی بریده می‌شود
+            if _drop_before(lst, cutoff_str):
+                cleaned = True
+
+    # رکوردهای snapshot از _append_entry نمی‌گذرند، پس رشته‌هایشان همین‌جا یکسان‌سازی می‌شوند
+    for lst in hist.values():
+        for entry in lst:
+            _intern_entry(entry)
+
+    _journal_seq = snap_seq
+    if os.path.exists(HISTORY_JOURNAL_FILE):
+        try:
+            with open(HISTORY_JOURNAL_FILE, "rb") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        rec = _loads(line)
+                        # خط‌های journal نسخه‌های قبلی شماره ندارند و فقط روی snapshot همان نسخه‌ها اعمال می‌شوند
+                        seq = rec.pop("s", 0)
+                        if seq > _journal_seq:
+                            _journal_seq = seq
+                        if snap_seq and seq <= snap_seq:
+                            # رکورد داخل snapshot است؛ شمرده می‌شود تا snapshot شروع برنامه journal را خالی کند
+                            _journal_records += 1
+                            continue
+                        if "op" in rec:
+                            # عملیات حذف (keep_last_n / keep_last_days) به همان ترتیب ثبت اعمال می‌شود
+                            if apply_history_op(hist, rec):
+                                cleaned = True
+                            _journal_records += 1
+                            continue
+                        peer = rec.pop("peer")
+                    except Exception:
+                        logger.warning("Skipping corrupt line in %s", HISTORY_JOURNAL_FILE)
+                        continue
+                    _journal_records += 1
+                    if cutoff_str is not None and (rec.get("time") or "") < cutoff_str:
+                        cleaned = True
+                        continue
+                    _append_entry(hist, peer, rec)
+        except Exception:
+            logger.exception("Failed to replay history journal")
+    if _journal_records and not _journal_seq:
+        # journal نسخه‌ی قبلی بدون شماره؛ snapshot بعدی با seq 1 نوشته می‌شود تا این خط‌ها دوباره اعمال نشوند
+        _journal_seq = 1
+    # اگر فایل نبود یا خطا داد، تاریخچه خالی برمی‌گرداند
+    return hist, cleaned
+
+def _write_synced(path, data, sync=True):
+    """نوشتن کامل داده در فایل با os.write (بدون بافر Python)؛ با sync=True قبل از بستن fsync می‌شود"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_dir_of(path):
+    """fsync پوشه‌ی فایل بعد از rename، فقط در حالت HISTORY_DURABILITY == "strict" (روی Windows ممکن نیست)"""
+    if HISTORY_DURABILITY != "strict" or _IS_WINDOWS:
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _content_hash(data):
+    """hash کوتاه محتوا برای تشخیص snapshot تکراری (BLAKE2b، 16 بایت)"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _atomic_write(path, data, durable=False):
+    """
+    نوشتن کامل فایل در یک فایل موقت و سپس جایگزینی با os.replace.
+    اگر برنامه وسط نوشتن متوقف شود، فایل قبلی سالم باقی می‌ماند.
+    با durable=True (فقط snapshot تاریخچه) فایل موقت قبل از replace با fsync روی دیسک می‌رود
+    تا بعد از قطع برق هم فایل خالی جای فایل قبلی را نگیرد؛ peers.json که مرتب بازنویسی می‌شود fsync نمی‌شود.
+    """
+    tmp = path + ".tmp"
+    _write_synced(tmp, data, sync=durable)
+    os.replace(tmp, path)
+    if durable:
+        _sync_dir_of(path)
+
 
 def load_peers():
     """بارگذاری لیست آی‌پی‌ها از فایل peers.json"""
     if os.path.exists(PEERS_FILE):
         try:
-            with open(PEERS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(PEERS_FILE, "rb") as f:
+                return _loads(f.read())
         except Exception:
             logger.exception("Failed to load peers file")
     return {}
@@ -93,48 +505,181 @@ def load_peers():
 def save_peers(peers):
     """ذخیره‌ی لیست آی‌پی‌ها در فایل peers.json"""
     try:
-        with open(PEERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(peers, f, ensure_ascii=False, indent=2)
+        _atomic_write(PEERS_FILE, _dumps(peers, indent=True))
     except Exception:
         logger.exception("Failed to save peers file")
 
 
 
 
+def _journal_file():
+    """برگرداندن فایل journal (در اولین استفاده در حالت append باز می‌شود)"""
+    global _journal_fh
+    if _journal_fh is None:
+        _journal_fh = open(HISTORY_JOURNAL_FILE, "ab")
+    return _journal_fh
+
+
+def _journal_write_pending():
+    """نوشتن همه‌ی خط‌های منتظر با یک write و flush فایل journal (باید با _journal_lock صدا زده شود)"""
+    fh = _journal_file()
+    if _journal_pending:
+        fh.write(b"".join(_journal_pending))
+        _journal_pending.clear()
+    fh.flush()
+    return fh
+
+
 # تابع برای ذخیره تاریخچه در فایل JSON
 def save_history(hist):
+    """
+    نوشتن snapshot کامل تاریخچه و سپس خالی کردن journal.
+    باید داخل history_exclusive() صدا زده شود.
+    """
+    global _journal_records, _snapshot_gen, _pruned_records, _snapshot_hash
+    with _journal_lock:
+        _snapshot_gen += 1
+        last_hash = _snapshot_hash
+        # همه‌ی رکوردهای journal تا این شماره در hist هستند
+        seq = _journal_seq
     try:
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(hist, f, ensure_ascii=False, indent=2)  # ذخیره با فرمت خوانا
+        # JSON فشرده؛ فایل تاریخچه فقط توسط خود برنامه خوانده می‌شود
+        data = _dumps(hist)
+        digest = _content_hash(data)
+        # اگر محتوا با snapshot روی دیسک یکی باشد، نوشتن و fsync لازم نیست
+        if digest != last_hash or not os.path.exists(HISTORY_FILE):
+            _atomic_write(HISTORY_FILE, _snapshot_bytes(seq, data), durable=True)
+            with _journal_lock:
+                _snapshot_hash = digest
     except Exception as e:
         logger.exception("Failed to save history file")
+        return
+    # رکوردهای journal حالا داخل snapshot هستند
+    try:
+        with _journal_lock:
+            _journal_pending.clear()
+            _journal_file().truncate(0)
+            _journal_records = 0
+            _pruned_records = 0
+    except Exception:
+        logger.exception("Failed to truncate history journal")
+
+
+def _journal_append(peer, entry):
+    """
+    افزودن یک رکورد به انتهای journal (هزینه O(1) به جای بازنویسی کل فایل).
+    رکورد فقط به _journal_pending اضافه می‌شود (بدون syscall در thread پیام)؛ flush_history_journal
+    هر HISTORY_FLUSH_INTERVAL ثانیه همه‌ی رکوردهای جمع‌شده را با یک write روی دیسک می‌برد.
+    فشرده‌سازی journal در thread پس‌زمینه (compact_history) انجام می‌شود.
+    """
+    global _journal_records, _journal_seq
+    body = _dumps({"peer": peer, **entry})
+    with _journal_lock:
+        _journal_seq += 1
+        # شماره‌ی رکورد جلوی JSON از قبل ساخته‌شده گذاشته می‌شود (سریال‌سازی بیرون از قفل می‌ماند)
+        _journal_pending.append(b'{"s":%d,%s\n' % (_journal_seq, body[1:]))
+        _journal_records += 1
+
+
+def _journal_append_op(op, removed):
+    """
+    ثبت یک عملیات حذف (tombstone) در journal به جای بازنویسی کل snapshot.
+    باید داخل history_exclusive() و بعد از اعمال همان عملیات روی history صدا زده شود؛
+    removed تعداد رکوردهای حذف‌شده است. اگر حذف‌شده‌ها نسبت به تاریخچه‌ی باقی‌مانده زیاد شوند
+    فشرده‌سازی در پس‌زمینه درخواست می‌شود.
+    """
+    global _journal_records, _pruned_records, _journal_seq
+    body = _dumps(op)
+    with _journal_lock:
+        _journal_seq += 1
+        _journal_pending.append(b'{"s":%d,%s\n' % (_journal_seq, body[1:]))
+        _journal_records += 1
+        _pruned_records += removed
+        pruned = _pruned_records
+    remaining = sum(len(lst) for lst in history.values())
+    if pruned > HISTORY_COMPACT_PRUNED_RATIO * remaining:
+        history_compact_needed.set()
+
+
+def flush_history_journal():
+    """نوشتن رکوردهای منتظر journal روی دیسک"""
+    with _journal_lock:
+        if _journal_pending or _journal_fh is not None:
+            _journal_write_pending()
 
-# بارگذاری تاریخچه قبلی (در صورت وجود)
-history = load_history()
+
+# رکوردهای بافرشده هنگام خروج از برنامه از دست نروند
+atexit.register(flush_history_journal)
+
+
+def compact_history():
+    """
+    ادغام journal در snapshot بدون نگه داشتن قفل‌های تاریخچه در طول سریال‌سازی و نوشتن:
+    زیر قفل فقط لیست‌ها کپی و موقعیت فعلی journal علامت زده می‌شود؛ بعد از نوشتن snapshot
+    فقط رکوردهای قبل از علامت از journal حذف می‌شوند و رکوردهای جدیدتر باقی می‌مانند
+    (journal کوتاه‌شده هم مثل snapshot با فایل موقت و os.replace جایگزین می‌شود).
+    (نباید با قفل‌های تاریخچه صدا زده شود)
+    """
+    global _journal_records, _pruned_records, _snapshot_hash, _journal_fh
+    with history_exclusive():
+        snap = {peer: list(lst) for peer, lst in history.items()}
+        with _journal_lock:
+            gen = _snapshot_gen
+            last_hash = _snapshot_hash
+            # snapshot رکوردهای journal تا همین شماره (تا علامت) را در بر دارد
+            seq = _journal_seq
+            fh = _journal_write_pending()
+            mark = fh.tell()
+            marked_records = _journal_records
+            marked_pruned = _pruned_records
+
+    data = _dumps(snap)
+    digest = _content_hash(data)
+    # snapshot یکسان با فایل فعلی (مثلاً journal فقط شامل عملیات بی‌اثر بود) نوشته نمی‌شود؛ فقط journal کوتاه می‌شود
+    unchanged = digest == last_hash and os.path.exists(HISTORY_FILE)
+    tmp = HISTORY_FILE + ".compact.tmp"
+    if not unchanged:
+        _write_synced(tmp, _snapshot_bytes(seq, data))
+
+    with _journal_lock:
+        if gen != _snapshot_gen:
+            # در این فاصله save_history یک snapshot جدیدتر نوشته است
+            if not unchanged:
+                os.remove(tmp)
+            return
+        if not unchanged:
+            os.replace(tmp, HISTORY_FILE)
+            _sync_dir_of(HISTORY_FILE)
+            _snapshot_hash = digest
+        _journal_write_pending()
+        with open(HISTORY_JOURNAL_FILE, "rb") as rf:
+            rf.seek(mark)
+            tail = rf.read()
+        # journal جدید (فقط رکوردهای بعد از علامت) در فایل موقت نوشته و با os.replace جایگزین می‌شود؛
+        # crash در هر لحظه یا journal کامل قبلی را باقی می‌گذارد (رکوردهای داخل snapshot با seq رد می‌شوند) یا journal جدید را
+        tmp = HISTORY_JOURNAL_FILE + ".tmp"
+        _write_synced(tmp, tail)
+        # فایل باز قبل از replace بسته می‌شود (روی Windows فایل باز جایگزین نمی‌شود)؛ _journal_file دوباره بازش می‌کند
+        fh.close()
+        _journal_fh = None
+        os.replace(tmp, HISTORY_JOURNAL_FILE)
+        _sync_dir_of(HISTORY_JOURNAL_FILE)
+        _journal_records -= marked_records
+        _pruned_records -= marked_pruned
 
 # تنظیم تعداد روزهایی که تاریخچه نگه‌داری می‌شود
 AUTO_CLEAN_DAYS = 30
 
-# پاکسازی خودکار تاریخچه قدیمی‌تر از X روز
+# بارگذاری تاریخچه قبلی (در صورت وجود)، همراه با پاکسازی خودکار رکوردهای قدیمی‌تر از X روز
+history, _auto_cleaned = load_history(AUTO_CLEAN_DAYS)
+if _auto_cleaned:
+    logger.info("Auto-cleaned history to last %d days.", AUTO_CLEAN_DAYS)
+
+# یک نوشتن snapshot در شروع برنامه: هم نتیجه‌ی پاکسازی و هم ادغام journal قبلی
 try:
-    cutoff = datetime.now() - timedelta(days=AUTO_CLEAN_DAYS)   # زمان مرجع حذف
-    with history_lock:
-        changed = False
-        for peer, lst in list(history.items()):  # پیمایش تاریخچه هر کاربر (peer)
-            new_lst = []
-            for entry in lst:
-                try:
-                    t = datetime.strptime(entry.get("time"), "%Y-%m-%d %H:%M:%S")
-                except Exception:
-                    continue
-                if t >= cutoff:                  # فقط پیام‌های جدیدتر از cutoff نگه‌داری می‌شوند
-                    new_lst.append(entry)
-            if len(new_lst) != len(lst):         # اگر چیزی حذف شد
-                history[peer] = new_lst
-                changed = True
-        if changed:                              # در صورت تغییر، ذخیره تاریخچه جدید
+    if _auto_cleaned or _journal_records:
+        with history_exclusive():
             save_history(history)
-            logger.info("Auto-cleaned history to last %d days.", AUTO_CLEAN_DAYS)
 except Exception:
     logger.exception("Auto-clean history failed")
 
@@ -147,37 +692,37 @@ def record_history(peer, direction, content, entry_type="msg"):
     - content: محتوای پیام
     - entry_type: نوع رکورد ("msg" برای پیام، "ping" برای پینگ)
     """
+    entry = {
+        "time": now(),
+        "dir": direction,
+        "msg": content,
+        "type": entry_type
+    }
     try:
-        with history_lock:
-            # گرفتن لیست رکوردهای مربوط به این همتا یا ساخت لیست جدید
-            lst = history.setdefault(peer, [])
-            # افزودن رکورد جدید
-            lst.append({
-                "time": now(),
-                "dir": direction,
-                "msg": content,
-                "type": entry_type
-            })
-            # اگر نوع رکورد "ping" باشد، تعداد پینگ‌ها را کنترل می‌کنیم
-            if entry_type == "ping":
-                pings = [i for i in lst if i.get("type") == "ping"]
-                if len(pings) > MAX_PING_RECORDS_PER_PEER:
-                    # حذف قدیمی‌ترین پینگ‌ها و نگه‌داشتن جدیدها
-                    remove_count = len(pings) - MAX_PING_RECORDS_PER_PEER
-                    new_lst = []
-                    removed = 0
-                    for it in lst:
-                        if it.get("type") == "ping" and removed < remove_count:
-                            removed += 1
-                            continue
-                        new_lst.append(it)
-                    history[peer] = new_lst
-            # ذخیره تاریخچه به‌روزشده
-            save_history(history)
+        # فقط قفل stripe همین همتا گرفته می‌شود (برای همتای جدید هم؛ پیمایش dict فقط با history_exclusive است)
+        with _peer_lock(peer):
+            # افزودن رکورد جدید به حافظه (محدودسازی پینگ‌ها داخل _append_entry انجام می‌شود)
+            _append_entry(history, peer, entry)
+            # فقط همین رکورد به انتهای journal اضافه می‌شود، نه بازنویسی کل تاریخچه
+            _journal_append(peer, entry)
+        if _journal_records >= HISTORY_JOURNAL_MAX_RECORDS:
+            # نوشتن snapshot در history_flusher انجام می‌شود، نه در thread ارسال/دریافت پیام
+            history_compact_needed.set()
     except Exception:
         logger.exception("record_history error")
 # ----------------- تابع گرفتن IP محلی -----------------
-def get_local_ip():
+# آخرین IP محلی و زمان به دست آوردن آن (برای جلوگیری از ساخت سوکت در هر بررسی دوره‌ای)
+_local_ip_cache = {"ip": None, "ts": 0.0}
+
+
+def get_local_ip(force=False):
+    """
+    برگرداندن IP محلی؛ نتیجه تا LOCAL_IP_CACHE_TTL ثانیه cache می‌شود.
+    با force=True مقدار تازه گرفته می‌شود.
+    """
+    cached = _local_ip_cache["ip"]
+    if not force and cached and time.monotonic() - _local_ip_cache["ts"] < LOCAL_IP_CACHE_TTL:
+        return cached
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
@@ -186,9 +731,11 @@ def get_local_ip():
             local_ip = s.getsockname()[0]
         finally:
             s.close()
-        return local_ip
     except Exception:
         return "127.0.0.1"
+    _local_ip_cache["ip"] = local_ip
+    _local_ip_cache["ts"] = time.monotonic()
+    return local_ip
 
 def center_window(window, width=None, height=None, parent=None):
     """
@@ -217,88 +764,323 @@ def center_window(window, width=None, height=None, parent=None):
 
 # ----------------- توابع رمزنگاری ساده با کلید مشترک -----------------
 
-def _key_bytes():
-    """برگشت کلید رمزنگاری به صورت بایت. اگر کلید خالی باشد، بایت خالی برمی‌گرداند."""
-    return SHARED_KEY.encode("utf-8") if SHARED_KEY else b""
-
-
 def _xor_encrypt(data_bytes):
     """
     تابع رمزنگاری/رمزگشایی با الگوریتم ساده XOR
     با استفاده از کلید مشترک (key)
     """
-    key = _key_bytes()
+    key, stream = _KEY_STREAM
     if not key:
         # اگر کلید تعریف نشده باشد، داده بدون تغییر برگردانده می‌شود
         return data_bytes
-    out = bytearray(len(data_bytes))
-    for i, b in enumerate(data_bytes):
-        # هر بایت داده با بایت متناظر کلید XOR می‌شود
-        out[i] = b ^ key[i % len(key)]
-    return bytes(out)
+    n = len(data_bytes)
+    if len(stream) < n:
+        stream = _grow_key_stream(key, n)
+    if numpy is not None and n >= XOR_NUMPY_MIN_SIZE:
+        # XOR برداری numpy روی همان بافرها، بدون ساخت عدد صحیح بزرگ
+        data = numpy.frombuffer(data_bytes, dtype=numpy.uint8)
+        return numpy.bitwise_xor(data, numpy.frombuffer(stream, dtype=numpy.uint8, count=n)).tobytes()
+    # کل داده یک‌جا (به صورت عدد صحیح بزرگ، داخل C) با کلید تکرارشده XOR می‌شود؛
+    # memoryview برش کلید را بدون کپی به int.from_bytes می‌دهد
+    x = int.from_bytes(data_bytes, "big") ^ int.from_bytes(memoryview(stream)[:n], "big")
+    return x.to_bytes(n, "big")
+
+
+# کلید تکرارشده (key stream) برای _xor_encrypt: (کلید، بایت‌ها). فقط بزرگ می‌شود و با تغییر کلید از نو ساخته می‌شود
+_KEY_STREAM = (b"", b"")
+
+
+def _grow_key_stream(key, n):
+    """ساخت key stream با طول حداقل n (توانی از ۲، حداقل 4KiB) و ذخیره در cache"""
+    global _KEY_STREAM
+    size = max(4096, 1 << (n - 1).bit_length())
+    stream = key * (size // len(key) + 1)
+    if _KEY_STREAM[0] is key:
+        # اگر در این فاصله کلید عوض شده باشد، stream کلید قدیمی در cache نوشته نمی‌شود
+        _KEY_STREAM = (key, stream)
+    return stream
+
+
+# نمونه‌ی آماده‌ی BLAKE2b کلیددار با کلید فعلی؛ برای هر پیام فقط copy می‌شود تا کلید دوباره پردازش نشود
+_MAC_TEMPLATE = None
+
+
+def _reset_key_cache():
+    """بازسازی مقادیر وابسته به SHARED_KEY؛ بعد از هر تغییر کلید باید صدا زده شود."""
+    global _MAC_TEMPLATE, _KEY_STREAM, pack_payload, unpack_payload
+    key = SHARED_KEY.encode("utf-8") if SHARED_KEY else b""
+    if key:
+        # کلید BLAKE2b حداکثر 64 بایت است؛ کلید بلندتر اول hash می‌شود
+        mac_key = key if len(key) <= hashlib.blake2b.MAX_KEY_SIZE else hashlib.blake2b(key).digest()
+        _MAC_TEMPLATE = hashlib.blake2b(key=mac_key, digest_size=_MAC_SIZE)
+    else:
+        _MAC_TEMPLATE = None
+    _KEY_STREAM = (key, b"")
+    if key:
+        _grow_key_stream(key, 1)
+    pack_payload = _pack_encrypted if key else _dumps
+    unpack_payload = _unpack_encrypted if key else _unpack_plain
 
-def make_hmac(data_bytes):
-    """
-    ساخت HMAC ساده با استفاده از SHA-256 برای اطمینان از صحت پیام
-    """
-    key = _key_bytes()
-    if not key:
-        return ""
-    # ترکیب کلید و داده و محاسبه هش SHA-256
-    h = hashlib.sha256(key + data_bytes).hexdigest()
-    return h
+
+def set_shared_key(key):
+    """تنظیم کلید اشتراکی و به‌روزرسانی مقادیر cache شده‌ی وابسته به آن"""
+    global SHARED_KEY
+    SHARED_KEY = key
+    _reset_key_cache()
 
 
-def pack_payload(obj):
+def make_mac(data_bytes):
     """
-    بسته‌بندی داده برای ارسال:
-    - اگر کلید اشتراکی تعریف نشده باشد → فقط JSON عادی برگردانده می‌شود.
-    - اگر کلید وجود داشته باشد → داده رمز می‌شود و همراه با HMAC ارسال می‌گردد.
+    ساخت MAC پاکت رمز شده با BLAKE2b کلیددار (16 بایت خام)؛ برای پیام‌های کوتاه سریع‌تر از HMAC-SHA256
     """
-    raw = json.dumps(obj).encode("utf-8")
-    if not SHARED_KEY:
-        return raw
-    enc = _xor_encrypt(raw)
-    return json.dumps({
-        "enc": 1,  # نشانه اینکه پیام رمزنگاری شده
-        "payload": enc.hex(),  # متن رمز شده به صورت hex
-        "hmac": make_hmac(enc).lower()  # HMAC برای صحت‌سنجی
-    }).encode("utf-8")
-
-
-def unpack_payload(raw_bytes):
+    template = _MAC_TEMPLATE
+    if template is None:
+        return b""
+    h = template.copy()
+    h.update(data_bytes)
+    return h.digest()
+
+
+# پاکت رمز شده‌ی باینری: ENC_MAGIC | MAC خام | متن رمز شده (بدون JSON و base64).
+# هیچ JSON معتبری با "E" شروع نمی‌شود، پس با پیام‌های ساده و opcode های پینگ اشتباه نمی‌شود.
+_ENC_MAGIC = b"ENC2"
+_MAC_SIZE = 16
+_ENC_HEADER_SIZE = len(_ENC_MAGIC) + _MAC_SIZE
+
+
+# pack_payload و unpack_payload در _reset_key_cache به پیاده‌سازی مناسب کلید فعلی bind می‌شوند
+# تا در حالت بدون کلید (حالت رایج) هیچ شرط و بررسی اضافه‌ای در مسیر هر پیام نباشد:
+# - بدون کلید اشتراکی → فقط JSON عادی (pack_payload همان _dumps است)
+# - با کلید اشتراکی → داده رمز می‌شود و همراه با MAC ارسال می‌گردد
+
+
+def _pack_encrypted(obj):
+    """بسته‌بندی داده برای ارسال وقتی کلید اشتراکی تعریف شده است"""
+    enc = _xor_encrypt(_dumps(obj))
+    return b"".join((_ENC_MAGIC, make_mac(enc), enc))
+
+
+def _unpack_plain(raw_bytes):
+    """بازکردن بسته دریافتی وقتی کلید اشتراکی نداریم؛ JSON مستقیماً برگردانده می‌شود"""
+    # _loads مستقیماً bytes را می‌پذیرد؛ UTF-8 نامعتبر هم به عنوان JSON نامعتبر رد می‌شود
+    try:
+        return _loads(raw_bytes)
+    except Exception:
+        # اگر پیام رمز شده باشد ولی ما کلید نداشته باشیم
+        if raw_bytes[:len(_ENC_MAGIC)] == _ENC_MAGIC:
+            raise ValueError("Received encrypted payload but no SHARED_KEY configured")
+        raise ValueError("Not JSON")
+
+
+def _unpack_encrypted(raw_bytes):
     """
-    بازکردن بسته دریافتی:
+    بازکردن بسته دریافتی وقتی کلید اشتراکی تعریف شده است:
     - اگر پیام ساده باشد، JSON را مستقیماً برمی‌گرداند.
-    - اگر پیام رمز شده باشد، HMAC چک می‌شود و سپس رمزگشایی انجام می‌گیرد.
+    - اگر پیام رمز شده باشد (پاکت باینری)، MAC چک می‌شود و سپس رمزگشایی انجام می‌گیرد.
     """
+    if raw_bytes[:len(_ENC_MAGIC)] == _ENC_MAGIC:
+        if len(raw_bytes) < _ENC_HEADER_SIZE:
+            raise ValueError("Truncated encrypted payload")
+        # بررسی تطابق MAC دریافتی با MAC محاسبه‌شده (مقایسه با زمان ثابت)
+        enc = raw_bytes[_ENC_HEADER_SIZE:]
+        if not hmac.compare_digest(make_mac(enc), raw_bytes[len(_ENC_MAGIC):_ENC_HEADER_SIZE]):
+            raise ValueError("MAC mismatch")
+        return _loads(_xor_encrypt(enc))
+
     try:
-        data = raw_bytes.decode("utf-8")
-    except Exception:
-        raise ValueError("Invalid encoding")
-    try:
-        obj = json.loads(data)
+        return _loads(raw_bytes)
     except Exception:
         raise ValueError("Not JSON")
 
-    # بررسی اینکه پیام رمز شده است یا نه
-    if isinstance(obj, dict) and obj.get("enc") == 1:
-        if not SHARED_KEY:
-            # اگر پیام رمز شده باشد ولی ما کلید نداشته باشیم
-            raise ValueError("Received encrypted payload but no SHARED_KEY configured")
-        payload_hex = obj.get("payload", "")
-        hmac_recv = obj.get("hmac", "").lower()
-        enc = bytes.fromhex(payload_hex)
 
-        # بررسی تطابق HMAC دریافتی با HMAC محاسبه‌شده
-        if make_hmac(enc).lower() != hmac_recv:
-            raise ValueError("HMAC mismatch")
+_reset_key_cache()
+
+
+# ----------------- فریم‌بندی پیام‌ها روی TCP -----------------
+# هر پیام با یک پیشوند ۴ بایتی طول (big-endian) فرستاده می‌شود تا چند پیام روی یک اتصال جا شوند
+
+_FRAME_HEADER = struct.Struct("!I")
+
+
+# پینگ/پونگ باینری: یک بایت opcode و ۸ بایت زمان ارسال (ns) که در پونگ عیناً برگردانده می‌شود.
+# بدون JSON، رمز و HMAC؛ هیچ JSON معتبر (و هیچ پاکت رمز شده‌ای) با بایت 0x01 یا 0x02 شروع نمی‌شود.
+_OP_PING = 0x01
+_OP_PONG = 0x02
+_HEARTBEAT = struct.Struct("!BQ")
+
+
+# نسخه‌های فریم‌شده برای TCP: هدر طول ثابت است و از پیش ساخته می‌شود
+_FRAMED_PING = struct.Struct("!IBQ")
+_PONG_FRAME_PREFIX = _FRAME_HEADER.pack(_HEARTBEAT.size) + bytes((_OP_PONG,))
+
+
+def make_ping():
+    """ساخت پیام پینگ باینری با زمان فعلی"""
+    return _HEARTBEAT.pack(_OP_PING, time.monotonic_ns())
+
+
+def make_pong(ping):
+    """ساخت پاسخ پونگ برای یک پینگ باینری (زمان پینگ برگردانده می‌شود)"""
+    return bytes((_OP_PONG,)) + ping[1:_HEARTBEAT.size]
 
-        # رمزگشایی داده و بازکردن JSON نهایی
-        dec = _xor_encrypt(enc)
-        return json.loads(dec.decode("utf-8"))
+
+def make_ping_frame():
+    """فریم کامل پینگ (هدر طول + پینگ) با یک struct.pack"""
+    return _FRAMED_PING.pack(_HEARTBEAT.size, _OP_PING, time.monotonic_ns())
+
+
+def make_pong_frame(ping):
+    """فریم کامل پونگ برای یک پینگ باینری"""
+    return _PONG_FRAME_PREFIX + ping[1:_HEARTBEAT.size]
+
+
+def pong_rtt_ms(data):
+    """
+    اگر data یک پونگ باینری معتبر باشد، زمان رفت و برگشت (میلی‌ثانیه) را برمی‌گرداند؛ وگرنه None.
+    """
+    if len(data) != _HEARTBEAT.size or data[0] != _OP_PONG:
+        return None
+    _, sent_ns = _HEARTBEAT.unpack(data)
+    return (time.monotonic_ns() - sent_ns) // 1_000_000
+
+
+def tune_tcp_socket(sock):
+    """
+    تنظیم سوکت TCP برای پیام‌های کوچک چت:
+    خاموش کردن Nagle (TCP_NODELAY) تا پیام‌ها بدون تأخیر فرستاده شوند،
+    و SO_KEEPALIVE تا اتصال همتای مرده توسط سیستم‌عامل تشخیص داده شود.
+    بافرهای ارسال/دریافت هم بزرگ می‌شوند؛ چون اندازه‌ی پنجره‌ی TCP هنگام اتصال تعیین می‌شود،
+    این تابع باید قبل از connect یا listen صدا زده شود (سوکت‌های accept شده از listener ارث می‌برند).
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    except OSError:
+        logger.debug("Could not set TCP options on socket", exc_info=True)
+
+
+# همتایان روی همین سیستم از طریق Unix domain socket پینگ می‌شوند (بدون عبور از پشته‌ی TCP/IP)
+_LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+_HAS_AF_UNIX = hasattr(socket, "AF_UNIX") and not _IS_WINDOWS
+
+
+# پوشه‌ی خصوصی کاربر برای Unix socket ها؛ یک بار در _runtime_dir تعیین می‌شود (False یعنی هنوز بررسی نشده)
+_runtime_dir_cache = False
+
+
+def _is_private_to_us(st):
+    """آیا فایل/پوشه متعلق به کاربر فعلی است و گروه و دیگران هیچ دسترسی‌ای به آن ندارند"""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def _runtime_dir():
+    """
+    پوشه‌ی Unix socket ها: XDG_RUNTIME_DIR/chatapp یا در نبود آن tmp/chatapp-<uid> با دسترسی 0700.
+    پوشه‌ای که متعلق به کاربر دیگری باشد یا دسترسی گروه/دیگران داشته باشد پذیرفته نمی‌شود (None)؛
+    در آن صورت پینگ همتایان محلی از TCP انجام می‌شود.
+    """
+    global _runtime_dir_cache
+    if _runtime_dir_cache is not False:
+        return _runtime_dir_cache
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base and os.path.isdir(base):
+        path = os.path.join(base, "chatapp")
     else:
-        return obj
+        path = os.path.join(tempfile.gettempdir(), f"chatapp-{os.getuid()}")
+    try:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or not _is_private_to_us(st):
+            logger.warning("Ignoring unsafe runtime directory %s", path)
+            path = None
+    except OSError as e:
+        logger.warning("Runtime directory %s unavailable: %s", path, e)
+        path = None
+    _runtime_dir_cache = path
+    return path
+
+
+def unix_socket_path(port):
+    """مسیر Unix socket شنونده‌ی محلی روی یک پورت (None اگر سیستم‌عامل پشتیبانی نکند یا پوشه‌ی امن نباشد)"""
+    if not _HAS_AF_UNIX:
+        return None
+    runtime_dir = _runtime_dir()
+    if runtime_dir is None:
+        return None
+    return os.path.join(runtime_dir, f"{port}.sock")
+
+
+def make_frame(payload):
+    """ساخت بایت‌های کامل یک فریم (هدر طول + داده)"""
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+# بافر دریافت هر thread؛ فریم‌های کوچک‌تر از این اندازه بدون هیچ تخصیص حافظه‌ای خوانده می‌شوند
+RX_BUFFER_SIZE = 64 * 1024
+_rx_local = threading.local()
+
+
+def _rx_buffer():
+    """برگرداندن memoryview بافر دریافت thread فعلی (در اولین استفاده ساخته می‌شود)"""
+    view = getattr(_rx_local, "view", None)
+    if view is None:
+        view = _rx_local.view = memoryview(bytearray(RX_BUFFER_SIZE))
+    return view
+
+
+def _recv_exact(sock, view):
+    """
+    پر کردن کامل view با داده‌ی سوکت (با recv_into و بدون bytes میانی).
+    اگر اتصال قبل از رسیدن هیچ بایتی بسته شود False برمی‌گرداند.
+    """
+    n = len(view)
+    got = 0
+    while got < n:
+        r = sock.recv_into(view[got:])
+        if not r:
+            if not got:
+                return False
+            raise ConnectionError("Connection closed in the middle of a frame")
+        got += r
+    return True
+
+
+def recv_frame(sock):
+    """
+    دریافت یک فریم کامل؛ در صورت بسته شدن عادی اتصال None برمی‌گرداند.
+    خروجی یک memoryview روی بافر دریافت همین thread است و فقط تا فراخوانی بعدی recv_frame
+    در همین thread معتبر است؛ اگر داده باید نگه داشته شود، از آن bytes ساخته شود.
+    """
+    buf = _rx_buffer()
+    header = buf[:_FRAME_HEADER.size]
+    if not _recv_exact(sock, header):
+        return None
+    (length,) = _FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large ({length} bytes)")
+    # فریم‌های بزرگ‌تر از بافر thread یک بافر جدا می‌گیرند
+    body = buf[:length] if length <= len(buf) else memoryview(bytearray(length))
+    if not _recv_exact(sock, body):
+        raise ConnectionError("Connection closed before frame body")
+    return body
+
+
+def _conn_alive(sock):
+    """
+    بررسی سریع (بدون بلاک شدن) اینکه اتصال نگه‌داشته‌شده هنوز توسط طرف مقابل بسته نشده باشد.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        return bool(sock.recv(1, socket.MSG_PEEK))
+    except (OSError, ValueError):
+        return False
 
 
 # ----------------- کلاس اصلی رابط کاربری چت -----------------
@@ -307,18 +1089,72 @@ class ChatApp:
         self.root = root
         self.root.title("Manual LAN Chat")
 
-        # گرفتن IP محلی
-        self.local_ip = get_local_ip()
-        # راه‌اندازی listener برای دریافت پیام‌ها (تعریف شده در جای دیگر کد)
-        self.listen_port = self.start_listener()
+        self._udp_sock = None
+        # شنونده‌ی Unix socket برای پینگ‌های همتایان روی همین سیستم (start_listener)
+        self._unix_sock = None
+        self._unix_path = None
 
-        # نگهداری لیست همتایان (peers) و پنجره‌های چت باز شده
-        self.peers = load_peers()
+        # توقف thread های پس‌زمینه هنگام بستن برنامه، و درخواست یک دور فوری بررسی همتایان
+        self._stop = threading.Event()
+        self._force_check = threading.Event()
+        # فقط یک عملیات تاریخچه (پاک کردن / keep_last_*) در هر زمان اجرا می‌شود (_run_history_task)
+        self._history_task_lock = threading.Lock()
 
-        self.chat_windows = {}
+        # اتصال‌های خروجی باز به همتایان: (ip, port) -> {"sock", "lock", "used"}
+        self._conn_pool = {}
+        self._conn_pool_lock = threading.Lock()
+
+        # اتصال‌های ورودی با یک selector پاییده می‌شوند و فقط فریم‌های آماده به این pool سپرده می‌شوند
+        self._handler_pool = ThreadPoolExecutor(max_workers=8)
+        self._rearm_conns = collections.deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        # انتخاب پردازشگر پیام‌های JSON دریافتی بر اساس فیلد "t" (handle_payload)
+        self._payload_handlers = {"msg": self._on_msg}
+
+        # ارسال پیام‌ها (اتصال و sendall) خارج از thread رابط کاربری؛ یک worker تا ترتیب پیام‌ها حفظ شود
+        self._send_pool = ThreadPoolExecutor(max_workers=1)
+
+        # زمان آخرین ثبت traceback خطای غیرمنتظره‌ی ping_peer (برای محدود کردن لاگ)
+        self._last_ping_err_log = 0.0
 
+        # پینگ‌های TCP دور بررسی؛ pool ثابت است تا هر دور thread های جدید ساخته نشوند (threadها به مرور و در صورت نیاز ساخته می‌شوند)
+        self._ping_pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_PINGS)
+
+        # نگهداری لیست همتایان (peers)؛ قبل از listener بارگذاری می‌شود تا اولین پیام‌های ورودی آن را ببینند.
+        # هر خواندن/نوشتن self.peers از thread های مختلف زیر _peers_lock انجام می‌شود.
+        self.peers = load_peers()
+        self._peers_lock = threading.RLock()
+        # ذخیره‌ی peers روی دیسک در یک thread جدا و به صورت تجمیعی انجام می‌شود (mark_peers_dirty)
+        self._peers_dirty = threading.Event()
+        self._peers_save_lock = threading.Lock()
+
+        # همه‌ی وضعیتی که پردازشگرهای پیام ورودی می‌خوانند قبل از listener ساخته می‌شود؛
+        # start_listener یک messagebox باز می‌کند و پیامی که در همان زمان برسد نباید به attribute ناموجود بخورد.
         # نگهداری IP هایی که پیام جدید دارند (برای ستاره‌دار کردن در لیست)
         self.new_msg_peers = set()
+        # پنجره‌های چت باز شده
+        self.chat_windows = {}
+        # فریم لیست همتایان در ui_setup ساخته می‌شود؛ تا آن موقع refresh_peers کاری نمی‌کند
+        self.list_frame = None
+        # ردیف‌های ساخته‌شده‌ی لیست همتایان: ip -> ویجت‌ها و آخرین وضعیت نمایش داده‌شده
+        self._peer_rows = {}
+        # آیا یک رفرش لیست همتایان از قبل زمان‌بندی شده است (_request_refresh)
+        self._refresh_pending = False
+        self._refresh_lock = threading.Lock()
+        # صدای اعلان را می‌توان در زمان اجرا خاموش کرد (مثلاً هنگام رگبار پیام‌ها)
+        self._notify_enabled = NOTIFY_SOUND_ENABLED
+        # زمان آخرین صدای اعلان هر همتا (time.monotonic)
+        self._last_sound = {}
+        # آخرین پیام دریافتی نمایش داده‌شده‌ی هر همتا: ip -> (ویجت Text، time.monotonic، انتهای متن)
+        self._last_bubble = {}
+
+        # گرفتن IP محلی
+        self.local_ip = get_local_ip()
+        # راه‌اندازی listener برای دریافت پیام‌ها (تعریف شده در جای دیگر کد)
+        self.listen_port = self.start_listener()
 
         # راه‌اندازی رابط کاربری
         self.ui_setup()
@@ -330,12 +1166,71 @@ class ChatApp:
         # حالا وسط‌چین کن
         center_window(self.root, 420, 650)
 
-        save_peers(self.peers)
-
+        self.mark_peers_dirty()
+        threading.Thread(target=self.peers_writer, daemon=True).start()
+        # تغییرات ذخیره‌نشده هنگام خروج از برنامه نوشته می‌شوند
+        atexit.register(self.flush_peers)
 
         # راه‌اندازی یک thread برای بررسی آنلاین بودن همتایان
         threading.Thread(target=self.check_peers_online, daemon=True).start()
+        # بستن اتصال‌های خروجی بیکار
+        threading.Thread(target=self.reap_idle_connections, daemon=True).start()
+        # نوشتن گروهی رکوردهای تاریخچه روی دیسک
+        threading.Thread(target=self.history_flusher, daemon=True).start()
         self.root.after(5000, self.auto_check_ip)  # هر 5 ثانیه بررسی IP
+        self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
+
+    def shutdown(self):
+        """
+        بستن منظم برنامه: توقف thread ها، بستن اتصال‌ها، ذخیره‌ی peers و بستن پنجره.
+        """
+        logger.info("Shutting down")
+        self._stop.set()
+        self._force_check.set()     # بیدار کردن check_peers_online
+        history_compact_needed.set()  # بیدار کردن history_flusher
+        self._peers_dirty.set()     # بیدار کردن peers_writer
+        try:
+            self._wake_w.send(b"\0")  # بیدار کردن listen_thread
+        except OSError:
+            pass
+        with self._conn_pool_lock:
+            entries = list(self._conn_pool.items())
+        for key, entry in entries:
+            self._drop_conn(key, entry)
+        self._send_pool.shutdown(wait=False)
+        self._handler_pool.shutdown(wait=False)
+        self._ping_pool.shutdown(wait=False)
+        try:
+            self.flush_peers()
+        except Exception:
+            logger.exception("Failed to save peers on shutdown")
+        # ادغام journal در snapshot تا شروع بعدی برنامه چیزی برای replay نداشته باشد
+        try:
+            with history_exclusive():
+                if _journal_records:
+                    save_history(history)
+            flush_history_journal()
+        except Exception:
+            logger.exception("Failed to save history on shutdown")
+        self.root.destroy()
+
+    def history_flusher(self):
+        """
+        flush دوره‌ای journal تاریخچه (group commit) تا هر رکورد یک syscall جدا نداشته باشد؛
+        فشرده‌سازی journal (history_compact_needed) هم در همین thread انجام می‌شود.
+        """
+        while True:
+            history_compact_needed.wait(HISTORY_FLUSH_INTERVAL)
+            if self._stop.is_set():
+                break
+            try:
+                if history_compact_needed.is_set():
+                    history_compact_needed.clear()
+                    compact_history()
+                flush_history_journal()
+                log_buffer.flush()
+            except Exception:
+                logger.exception("history_flusher failed")
 
     def ui_setup(self):
         """
@@ -437,52 +1332,103 @@ class ChatApp:
 
     def refresh_peers(self):
         """
-        نسخه اصلاح‌شده: به‌روزرسانی لیست کاربران و افزودن قابلیت باز کردن چت با دوبار کلیک روی IP
+        به‌روزرسانی لیست کاربران و افزودن قابلیت باز کردن چت با دوبار کلیک روی IP.
+        ردیف‌ها فقط یک بار ساخته می‌شوند؛ در رفرش‌های بعدی فقط رنگ وضعیت و متن ردیف‌های تغییرکرده
+        به‌روز می‌شود و ردیف همتایان حذف‌شده از بین می‌رود.
         """
-        # پاک کردن ویجت‌های قبلی در فریم
-        for widget in self.list_frame.winfo_children():
-            widget.destroy()
+        if self.list_frame is None:
+            # رابط کاربری هنوز ساخته نشده؛ ui_setup خودش بعداً لیست را می‌سازد
+            return
+        rows = self._peer_rows
+        seen = set()
 
-        # ایجاد ردیف جدید برای هر IP
-        for ip, info in self.peers.items():
+        with self._peers_lock:
+            items = tuple(self.peers.items())
+
+        for ip, info in items:
             # خود سیستم را در لیست نشان نده
             if ip == self.local_ip:
                 continue
+            seen.add(ip)
 
-            row = tk.Frame(self.list_frame, bg="#ffffff")
-            row.pack(fill="x", padx=6, pady=3)
-
-            # نقطه‌ی وضعیت (آنلاین / آفلاین)
+            # نقطه‌ی وضعیت (آنلاین / آفلاین) و متن IP:Port
             color = "green" if info.get("online") else "red"
-            canvas = tk.Canvas(row, width=16, height=16, bg="#ffffff", highlightthickness=0)
-            canvas.create_oval(3, 3, 13, 13, fill=color, outline=color)
-            canvas.pack(side="left", padx=(0, 8))
-
-            # متن IP:Port
             label_text = f"{ip}:{info['port']}"
             if ip in self.new_msg_peers:
                 label_text = "⭐ " + label_text
 
-            # ساخت لیبل برای نمایش IP
-            lbl = tk.Label(
-                row,
-                text=label_text,
-                bg="#ffffff",
-                fg="#000000",
-                font=("Segoe UI", 10)
-            )
-            lbl.pack(side="left", padx=2)
+            row = rows.get(ip)
+            if row is None:
+                frame = tk.Frame(self.list_frame, bg="#ffffff")
+                frame.pack(fill="x", padx=6, pady=3)
+
+                canvas = tk.Canvas(frame, width=16, height=16, bg="#ffffff", highlightthickness=0)
+                oval = canvas.create_oval(3, 3, 13, 13, fill=color, outline=color)
+                canvas.pack(side="left", padx=(0, 8))
+
+                # ساخت لیبل برای نمایش IP
+                lbl = tk.Label(
+                    frame,
+                    text=label_text,
+                    bg="#ffffff",
+                    fg="#000000",
+                    font=("Segoe UI", 10)
+                )
+                lbl.pack(side="left", padx=2)
+
+                # 👇 افزودن قابلیت دوبارکلیک برای باز کردن چت (یک handler مشترک؛ IP روی خود لیبل ذخیره می‌شود)
+                lbl.peer_ip = ip
+                lbl.bind("<Double-Button-1>", self._on_peer_dblclick)
+
+                rows[ip] = {"frame": frame, "canvas": canvas, "oval": oval,
+                            "label": lbl, "color": color, "text": label_text}
+                continue
 
-            # 👇 افزودن قابلیت دوبارکلیک برای باز کردن چت
-            lbl.bind("<Double-Button-1>", lambda e, ip=ip: self.open_chat(ip))
+            # ردیف موجود: فقط در صورت تغییر به‌روزرسانی می‌شود
+            if row["color"] != color:
+                row["canvas"].itemconfig(row["oval"], fill=color, outline=color)
+                row["color"] = color
+            if row["text"] != label_text:
+                row["label"].config(text=label_text)
+                row["text"] = label_text
 
-    
-    def check_local_ip_change(self):
+        # حذف ردیف همتایانی که دیگر در لیست نیستند
+        for ip in [ip for ip in rows if ip not in seen]:
+            rows.pop(ip)["frame"].destroy()
+
+        # هر ویجت دیگری در فریم (مثل listbox اولیه) مانند قبل حذف می‌شود
+        managed = {row["frame"] for row in rows.values()}
+        for widget in self.list_frame.winfo_children():
+            if widget not in managed:
+                widget.destroy()
+
+    def _request_refresh(self):
+        """
+        درخواست رفرش لیست همتایان (از هر thread).
+        درخواست‌های پشت سر هم تا اجرای رفرش بعدی در یک رفرش جمع می‌شوند.
+        """
+        with self._refresh_lock:
+            if self._refresh_pending:
+                return
+            self._refresh_pending = True
+        self.root.after(REFRESH_DEBOUNCE_MS, self._do_refresh)
+
+    def _do_refresh(self):
+        with self._refresh_lock:
+            self._refresh_pending = False
+        self.refresh_peers()
+
+    def _on_peer_dblclick(self, event):
+        """باز کردن چت همتای ردیفی که روی آن دوبار کلیک شده است"""
+        self.open_chat(event.widget.peer_ip)
+
+    def check_local_ip_change(self, force=False):
         """
         بررسی تغییر IP محلی و بروزرسانی در UI و فایل peers
+        - force: نادیده گرفتن IP محلی cache شده
         """
         try:
-            current_ip = get_local_ip()
+            current_ip = get_local_ip(force=force)
             current_port = self.listen_port
 
             if current_ip != self.local_ip:
@@ -497,11 +1443,11 @@ class ChatApp:
                     logger.warning("Failed to update IP label in UI")
 
                 # بروزرسانی peers
-                if old_ip in self.peers:
-                    self.peers.pop(old_ip)
-                
+                with self._peers_lock:
+                    self.peers.pop(old_ip, None)
+
 
-                save_peers(self.peers)
+                self.mark_peers_dirty()
                 self.refresh_peers()
 
         except Exception as e:
@@ -516,7 +1462,7 @@ class ChatApp:
         - رفرش رابط کاربری
         """
         logger.info("Manual refresh triggered")
-        self.check_local_ip_change()
+        self.check_local_ip_change(force=True)
         self.refresh_peers()
         self.ip_label.config(text=f"Your IP: {self.local_ip}:{self.listen_port}")
 
@@ -530,20 +1476,23 @@ class ChatApp:
         """
         افزودن یک همتای جدید به صورت دستی با وارد کردن IP:Port
         """
-        txt = simpledialog.askstring("Connect", "Enter IP:Port of peer")
+        txt = simpledialog.askstring("Connect", "Enter IP:Port of peer", parent=self.root)
         if not txt:
             return
         try:
             ip, port = txt.split(":")
             port = int(port)
-            # افزودن به لیست همتایان
-            self.peers[ip] = {"port": port, "online": True}
+            # افزودن به لیست همتایان؛ همتای دستی هیچ‌وقت با پر شدن لیست (MAX_PEERS) حذف نمی‌شود
+            with self._peers_lock:
+                self.peers[ip] = {"port": port, "online": True, "manual": True}
+            self.mark_peers_dirty()
+            self._force_check.set()     # بررسی فوری وضعیت همتای جدید
             self.refresh_peers()
-            messagebox.showinfo("Connected", f"Added {ip}:{port}")
+            messagebox.showinfo("Connected", f"Added {ip}:{port}", parent=self.root)
             logger.info("User added peer %s:%d", ip, port)
         except Exception as e:
             logger.exception("manual_connect failed")
-            messagebox.showerror("Error", "Invalid IP:Port format")
+            messagebox.showerror("Error", "Invalid IP:Port format", parent=self.root)
             
 
 
@@ -588,51 +1537,59 @@ class ChatApp:
         tk.Label(header, text=f"Chat with {ip}", bg="#5b9bd5", fg="white",
                  font=("Segoe UI", 12, "bold")).pack(side="left", padx=10, pady=10)
 
-        # بخش پیام‌ها
+        # بخش پیام‌ها: یک ویجت Text با tag برای هر نوع پیام، به جای یک Frame و Label برای هر پیام
         chat_frame = tk.Frame(win, bg="#e7eefb")
         chat_frame.pack(fill="both", expand=True)
 
-        canvas = tk.Canvas(chat_frame, bg="#e7eefb", highlightthickness=0)
-        scrollbar = tk.Scrollbar(chat_frame, command=canvas.yview)
-        scroll_frame = tk.Frame(canvas, bg="#e7eefb")
-
-        scroll_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-        canvas.create_window((0, 0), window=scroll_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        canvas.pack(side="left", fill="both", expand=True)
+        chat_text = tk.Text(chat_frame, bg="#e7eefb", wrap="word", relief="flat",
+                            font=("Segoe UI", 10), padx=10, pady=6, state="disabled")
+        scrollbar = tk.Scrollbar(chat_frame, command=chat_text.yview)
+        chat_text.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
-        # تابع ساخت حباب پیام
-        def add_bubble(sender, msg, t=None):
-            frame = tk.Frame(scroll_frame, bg="#e7eefb")
-            anchor = "e" if sender == "me" else "w"
-            color = "#d0e7ff" if sender == "me" else "white"
-
-            bubble = tk.Label(
-                frame, text=msg, bg=color, fg="black",
-                font=("Segoe UI", 10), wraplength=320,
-                padx=10, pady=6, justify="left",
-                relief="ridge", bd=1
-            )
-            bubble.pack(anchor=anchor, padx=10, pady=3)
-
-            if t:
-                tk.Label(frame, text=t, bg="#e7eefb", fg="#777",
-                         font=("Segoe UI", 8)).pack(anchor=anchor)
-            frame.pack(fill="x", pady=3)
-
-            canvas.update_idletasks()
-            canvas.yview_moveto(1)
-            return win
-
-
-        # نمایش تاریخچه قبلی
-        with history_lock:
-            for msg in history.get(ip, []):
-                if msg.get("type") != "msg":
-                    continue
+        chat_text.tag_configure("me", background="#d0e7ff", justify="right",
+                                lmargin1=60, lmargin2=60, spacing1=6)
+        chat_text.tag_configure("you", background="white", justify="left",
+                                rmargin=60, spacing1=6)
+        chat_text.tag_configure("system", foreground="#b00", justify="center", spacing1=6)
+        chat_text.tag_configure("time", foreground="#777", font=("Segoe UI", 8), spacing3=3)
+
+        # نمایش تاریخچه قبلی: فقط CHAT_HISTORY_PAGE پیام آخر؛ بقیه با رسیدن اسکرول به بالا اضافه می‌شوند.
+        # خطوط هر صفحه با یک فراخوانی insert (یک رفت‌وبرگشت به Tcl) درج می‌شوند
+        older = [m for m in get_peer_history(ip) if m.get("type") == "msg"]
+        loading = [False]
+
+        def insert_page(index):
+            page = older[-CHAT_HISTORY_PAGE:]
+            del older[-CHAT_HISTORY_PAGE:]
+            args = []
+            for msg in page:
                 sender = "me" if msg["dir"] == "out" else "you"
-                add_bubble(sender, msg["msg"], msg["time"])
+                args.extend(self._chat_line_args(sender, msg["msg"], msg["time"]))
+            if args:
+                chat_text.config(state="normal")
+                chat_text.insert(index, *args)
+                chat_text.config(state="disabled")
+
+        def load_older():
+            loading[0] = False
+            if not older or not chat_text.winfo_exists():
+                return
+            # mark با gravity راست بعد از متن درج‌شده می‌ماند تا دید کاربر روی همان پیام قبلی حفظ شود
+            chat_text.mark_set("view_top", "1.0")
+            insert_page("1.0")
+            chat_text.yview("view_top")
+
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            # قبل از نمایش پنجره، موقعیت اسکرول هنوز معنی ندارد
+            if older and not loading[0] and float(first) <= 0.0 and chat_text.winfo_ismapped():
+                loading[0] = True
+                chat_text.after_idle(load_older)
+
+        chat_text.configure(yscrollcommand=on_scroll)
+        insert_page("end")
+        chat_text.see("end")
 
         # نوار پایین
         bottom = tk.Frame(win, bg="#f0f2f7")
@@ -646,31 +1603,59 @@ class ChatApp:
             if not msg:
                 return
             entry.delete(0, tk.END)
-            ok = self.send_message(ip, port, msg)
-            if ok:
-                add_bubble("me", msg, now())
-                record_history(ip, "out", msg, entry_type="msg")
-            else:
-                add_bubble("system", "[Send failed]")
+            t = now()
+
+            def show_result(ok):
+                if self.chat_windows.get(ip, (None, None))[1] is not chat_text:
+                    return  # پنجره در این فاصله بسته (یا دوباره باز) شده است
+                if ok:
+                    self.append_to_chat_window(ip, "me", msg, t)
+                else:
+                    self.append_to_chat_window(ip, "system", "[Send failed]")
+
+            def deliver():
+                # در thread ارسال اجرا می‌شود؛ نتیجه با root.after به thread رابط کاربری برمی‌گردد
+                ok = self.send_message(ip, port, msg)
+                if ok:
+                    record_history(ip, "out", msg, entry_type="msg")
+                self.root.after(0, show_result, ok)
+
+            self._send_pool.submit(deliver)
 
         send_btn = tk.Button(bottom, text="✈️", bg="#5b9bd5", fg="white",
                              font=("Segoe UI", 11, "bold"), relief="flat",
                              width=4, command=send_msg)
         send_btn.pack(side="right")
 
-        self.chat_windows[ip] = (win, scroll_frame)
-        win.chat_area = scroll_frame
+        self.chat_windows[ip] = (win, chat_text)
+        win.chat_area = chat_text
 
 
         def on_close():
             if ip in self.chat_windows:
                 del self.chat_windows[ip]
+            self._last_bubble.pop(ip, None)
             self.new_msg_peers.discard(ip)
             self.refresh_peers()
             win.destroy()
 
         win.protocol("WM_DELETE_WINDOW", on_close)
 
+    @staticmethod
+    def _chat_line_args(sender, msg, t=None):
+        """آرگومان‌های (متن، tagها) ویجت Text برای یک پیام و زمان آن"""
+        if t:
+            return (msg + "\n", (sender,), t + "\n", (sender, "time"))
+        return (msg + "\n", (sender,))
+
+    @staticmethod
+    def _insert_chat_line(chat_text, sender, msg, t=None):
+        """
+        درج یک پیام (و زمان آن) در ویجت Text پنجره چت با tag فرستنده.
+        ویجت باید در وضعیت normal باشد.
+        """
+        chat_text.insert("end", *ChatApp._chat_line_args(sender, msg, t))
+
     # ----------------- راه‌اندازی Listener (برای دریافت پیام‌های ورودی) -----------------
 
     def start_listener(self):
@@ -693,6 +1678,7 @@ class ChatApp:
 
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tune_tcp_socket(s)
 
             # تلاش برای bind روی پورت ذخیره‌شده
             bound = False
@@ -715,31 +1701,65 @@ class ChatApp:
             # قرار دادن سوکت در حالت شنود
             s.listen(5)
 
+            # سوکت UDP روی همان شماره پورت برای پاسخ سریع به پینگ‌ها (بدون handshake)
+            self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self._udp_sock.bind(("", port))
+                self._udp_sock.setblocking(False)
+            except OSError as e:
+                logger.warning("UDP ping responder disabled, cannot bind UDP port %d: %s", port, e)
+                self._udp_sock.close()
+                self._udp_sock = None
+
+            # Unix socket روی همان شماره پورت برای پینگ‌های برنامه‌های دیگر روی همین سیستم.
+            # فایل socket در پوشه‌ی خصوصی کاربر (_runtime_dir) ساخته می‌شود و چون پورت TCP در اختیار ماست،
+            # socket باقی‌مانده با همین نام متعلق به اجرای قبلی است
+            path = unix_socket_path(port)
+            if path:
+                u = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    try:
+                        st = os.lstat(path)
+                    except FileNotFoundError:
+                        st = None
+                    if st is not None:
+                        # فقط socket باقی‌مانده‌ی خود ما حذف می‌شود، نه هر فایلی که با این نام وجود دارد
+                        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+                            raise OSError(f"refusing to replace {path}: not our socket")
+                        os.unlink(path)
+                    u.bind(path)
+                    u.listen(5)
+                    self._unix_sock, self._unix_path = u, path
+                except OSError as e:
+                    logger.warning("Local Unix socket disabled (%s): %s", path, e)
+                    u.close()
+
             # راه‌اندازی نخ گوش‌دهنده
             threading.Thread(target=self.listen_thread, args=(s,), daemon=True).start()
 
             # اطلاع در رابط کاربری
             logger.info("Listening on port %d", port)
-            messagebox.showinfo("Listening", f"✅ Listening on port {port}")
+            messagebox.showinfo("Listening", f"✅ Listening on port {port}", parent=self.root)
             return port
 
         except OSError as e:
             logger.exception("Failed to bind or listen on port")
             messagebox.showerror(
                 "Error",
-                f"❌ Cannot start listener on port {port if 'port' in locals() else '?'}\n\n{e}"
+                f"❌ Cannot start listener on port {port if 'port' in locals() else '?'}\n\n{e}",
+                parent=self.root
             )
             return None
         except Exception as e:
             logger.exception("Unexpected error in start_listener")
-            messagebox.showerror("Error", f"Unexpected error while starting listener:\n\n{e}")
+            messagebox.showerror("Error", f"Unexpected error while starting listener:\n\n{e}", parent=self.root)
             return None
 
     def test_connection(self):
         """
         تست دستی اتصال به یک IP:Port، با نمایش دلیل دقیق در صورت خطا.
         """
-        txt = simpledialog.askstring("Test Connection", "Enter IP:Port to test:")
+        txt = simpledialog.askstring("Test Connection", "Enter IP:Port to test:", parent=self.root)
         if not txt:
             return
 
@@ -747,17 +1767,19 @@ class ChatApp:
             ip, port = txt.split(":")
             port = int(port)
         except Exception:
-            messagebox.showerror("Error", "Invalid format. Use like: 192.168.2.52:5050")
+            messagebox.showerror("Error", "Invalid format. Use like: 192.168.2.52:5050", parent=self.root)
             return
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_tcp_socket(s)
         s.settimeout(3)
 
         try:
-            start = time.time()
+            # شمارنده‌ی یکنواخت با دقت نانوثانیه؛ مستقل از تغییر ساعت سیستم
+            start = time.perf_counter_ns()
             s.connect((ip, port))
-            elapsed = int((time.time() - start) * 1000)
-            messagebox.showinfo("Success", f"✅ Connected to {ip}:{port}\nRTT: {elapsed} ms")
+            elapsed = (time.perf_counter_ns() - start) // 1_000_000
+            messagebox.showinfo("Success", f"✅ Connected to {ip}:{port}\nRTT: {elapsed} ms", parent=self.root)
             s.close()
             return
 
@@ -779,120 +1801,290 @@ class ChatApp:
         finally:
             s.close()
 
-        messagebox.showerror("Failed", f"❌ Connection to {ip}:{port} failed.\n\n{reason}")
+        messagebox.showerror("Failed", f"❌ Connection to {ip}:{port} failed.\n\n{reason}", parent=self.root)
 
 
     def listen_thread(self, sock):
-        while True:
+        """
+        حلقه‌ی selector برای همه‌ی اتصال‌های ورودی (به جای یک thread برای هر اتصال):
+        - اتصال‌های جدید accept و در selector ثبت می‌شوند
+        - وقتی روی یک اتصال داده آمد، از selector خارج و خواندن فریم به pool سپرده می‌شود
+        - بعد از پردازش فریم، اتصال از طریق _rearm_conns دوباره در selector ثبت می‌شود
+        - اتصال‌هایی که بیش از 2 * PEER_CONN_IDLE_TIMEOUT بیکار بمانند بسته می‌شوند
+        """
+        sel = selectors.DefaultSelector()
+        sel.register(sock, selectors.EVENT_READ, "accept")
+        sel.register(self._wake_r, selectors.EVENT_READ, "wake")
+        if self._udp_sock is not None:
+            sel.register(self._udp_sock, selectors.EVENT_READ, "udp")
+        if self._unix_sock is not None:
+            sel.register(self._unix_sock, selectors.EVENT_READ, "accept_unix")
+        idle_limit = PEER_CONN_IDLE_TIMEOUT * 2
+        while not self._stop.is_set():
             try:
-                conn, addr = sock.accept()
-                threading.Thread(
-                    target=self.handle_conn, args=(conn, addr), daemon=True
-                ).start()
+                for key, _ in sel.select(timeout=idle_limit / 4):
+                    if key.data == "accept":
+                        conn, addr = sock.accept()
+                        conn.setblocking(True)
+                        tune_tcp_socket(conn)
+                        sel.register(conn, selectors.EVENT_READ, (addr, time.monotonic()))
+                    elif key.data == "accept_unix":
+                        conn, _ = key.fileobj.accept()
+                        conn.setblocking(True)
+                        # اتصال محلی آدرس IP ندارد؛ پورت None یعنی پورت ذخیره‌شده‌ی همتا تغییر نکند
+                        sel.register(conn, selectors.EVENT_READ, (("127.0.0.1", None), time.monotonic()))
+                    elif key.data == "udp":
+                        self.handle_datagram(key.fileobj)
+                    elif key.data == "wake":
+                        try:
+                            self._wake_r.recv(4096)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        sel.unregister(key.fileobj)
+                        self._handler_pool.submit(self.handle_conn, key.fileobj, key.data[0])
+
+                while self._rearm_conns:
+                    conn, addr = self._rearm_conns.popleft()
+                    sel.register(conn, selectors.EVENT_READ, (addr, time.monotonic()))
+
+                cutoff = time.monotonic() - idle_limit
+                for key in list(sel.get_map().values()):
+                    if isinstance(key.data, tuple) and key.data[1] < cutoff:
+                        logger.debug("Closing idle connection from %s", key.data[0][0])
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
             except OSError as e:
                 logger.warning("Socket closed or invalid: %s", e)
                 break
             except Exception:
                 logger.exception("Error in listen_thread")
+
+        # بستن listener، سوکت UDP و اتصال‌های ورودی باقی‌مانده
+        for key in list(sel.get_map().values()):
+            if key.fileobj is not self._wake_r:
+                try:
+                    key.fileobj.close()
+                except OSError:
+                    pass
+        sel.close()
+        if self._unix_path:
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+
+    def handle_datagram(self, udp):
+        """
+        پاسخ به پینگ‌های UDP؛ از این مسیر فقط پینگ پذیرفته می‌شود.
+        """
+        try:
+            data, addr = udp.recvfrom(65535)
+        except (BlockingIOError, ConnectionError):
+            return
+        if not data or data[0] != _OP_PING:
+            logger.debug("Ignoring invalid datagram from %s", addr[0])
+            return
+        try:
+            udp.sendto(make_pong(data), addr)
+        except OSError as e:
+            logger.debug("Failed to send UDP PONG to %s: %s", addr[0], e)
+            return
+        self._mark_peer_seen(addr[0])
+
     def handle_conn(self, conn, addr):
         """
-        مدیریت اتصال ورودی:
-        - دریافت و رمزگشایی پیام
-        - تشخیص نوع پیام (PING / PONG / MSG)
-        - ساده‌سازی شده برای کاهش شلوغی و حذف ذخیره‌ی پینگ‌پونگ
+        مدیریت یک فریم روی اتصال ورودی (در thread های pool اجرا می‌شود):
+        - خواندن یک فریم کامل و پردازش آن در handle_payload
+        - اگر اتصال باز بماند، برای فریم‌های بعدی به selector برگردانده می‌شود
         """
         ip = addr[0]
         try:
-            data = conn.recv(8192)
-            if not data:
-                conn.close()
+            # بعد از اعلام آماده بودن داده، بقیه‌ی فریم باید سریع برسد
+            conn.settimeout(5)
+            data = recv_frame(conn)
+            if data is not None:
+                self.handle_payload(conn, addr, data)
+                self._rearm_conns.append((conn, addr))
+                try:
+                    self._wake_w.send(b"\0")
+                except BlockingIOError:
+                    pass    # selector در هر حال بیدار می‌شود
                 return
+        except Exception as e:
+            logger.warning("handle_conn error for %s: %s", ip, e)
+        try:
+            conn.close()
+        except Exception:
+            pass
 
-            # تلاش برای رمزگشایی پیام
+    def handle_payload(self, conn, addr, data):
+        """
+        پردازش یک فریم دریافتی:
+        - رمزگشایی پیام
+        - تشخیص نوع پیام (PING / PONG / MSG)
+        - ساده‌سازی شده برای کاهش شلوغی و حذف ذخیره‌ی پینگ‌پونگ
+        """
+        ip = addr[0]
+        # پینگ/پونگ باینری قبل از هر پردازش JSON بررسی می‌شود
+        op = data[0] if data else None
+        if op == _OP_PING:
             try:
-                obj = unpack_payload(data)
-                # فقط در حالت debug نمایش داده شود
-                logger.debug("handle_conn from %s (source_port=%s): %s", addr[0], addr[1], obj)
-            except Exception as e:
-                logger.warning("Failed to unpack payload from %s: %s", ip, e)
-                conn.close()
+                conn.sendall(make_pong_frame(data))
+            except Exception:
+                logger.debug("Failed to send PONG to %s", ip)
                 return
+            self._mark_peer_seen(ip, addr[1])
+            return
+        if op == _OP_PONG:
+            self._mark_peer_seen(ip)
+            logger.debug("Received PONG from %s", ip)
+            return
 
-            # ----------------- 1. PING -----------------
-            if isinstance(obj, dict) and "ping" in obj:
-                # پاسخ پونگ برای تأیید آنلاین بودن
-                resp = {"pong": 1, "rtt_ms": 0}
-                try:
-                    conn.send(pack_payload(resp))
-                    # به‌روزرسانی وضعیت آنلاین در peers
-                    if ip not in self.peers:
-                        self.peers[ip] = {"port": addr[1], "online": True}
-                    else:
-                        self.peers[ip]["online"] = True
-                    self.peers[ip]["last_seen"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_peers(self.peers)
-                except Exception:
-                    logger.debug("Failed to send PONG to %s", ip)
-
-            # ----------------- 2. PONG -----------------
-            elif isinstance(obj, dict) and "pong" in obj:
-                # فقط به‌روزرسانی وضعیت آنلاین، بدون ثبت یا لاگ
-                if ip in self.peers:
-                    self.peers[ip]["online"] = True
-                    self.peers[ip]["last_seen"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_peers(self.peers)
-                logger.debug("Received PONG from %s", ip)
-
-            # ----------------- 3. MSG -----------------
-            elif isinstance(obj, dict) and "msg" in obj:
-                msg = obj["msg"]
-                sender_port = None
-                if "from_port" in obj:
-                    try:
-                        sender_port = int(obj["from_port"])
-                    except Exception:
-                        sender_port = obj.get("from_port")
+        # تلاش برای رمزگشایی پیام
+        try:
+            obj = unpack_payload(data)
+            # فقط در حالت debug نمایش داده شود
+            logger.debug("handle_conn from %s (source_port=%s): %s", addr[0], addr[1], obj)
+        except Exception as e:
+            logger.warning("Failed to unpack payload from %s: %s", ip, e)
+            return
 
-                # پیام تست داخلی را نادیده بگیر
-                if msg == "__TEST_REPLY__":
-                    if sender_port:
-                        self.peers[ip] = {"port": sender_port, "online": True}
-                        save_peers(self.peers)
-                    try:
-                        self.root.after(0, self.refresh_peers)
-                    except Exception:
-                        logger.debug("Failed to refresh peers after TEST_REPLY")
-                    return
+        if not isinstance(obj, dict):
+            logger.debug("Unknown object from %s: %s", ip, obj)
+            return
 
-                # پیام واقعی: ذخیره و نمایش
-                try:
-                    record_history(ip, "in", msg, entry_type="msg")
-                except Exception:
-                    logger.warning("Failed to record incoming msg from %s", ip)
+        # نوع پیام با یک جست‌وجو در dict بر اساس فیلد "t" انتخاب می‌شود
+        handler = self._payload_handlers.get(obj.get("t"))
+        if handler is None:
+            logger.debug("Unknown object from %s: %s", ip, obj)
+            return
+        handler(conn, addr, obj)
 
-                logger.info("Received message from %s", ip)
-                if sender_port:
-                    self.peers[ip] = {"port": sender_port, "online": True}
-                    save_peers(self.peers)
+    # ----------------- MSG -----------------
+    def _on_msg(self, conn, addr, obj):
+        """ذخیره و نمایش پیام دریافتی"""
+        ip = addr[0]
+        msg = obj.get("msg")
+        if msg is None:
+            logger.debug("Message without text from %s: %s", ip, obj)
+            return
+        if not isinstance(msg, str):
+            # تاریخچه و پنجره چت فقط متن می‌پذیرند؛ مقدار غیرمتنی (عدد، لیست...) مثل قبل به متن تبدیل می‌شود
+            msg = str(msg)
+        sender_port = None
+        if "from_port" in obj:
+            try:
+                sender_port = int(obj["from_port"])
+            except Exception:
+                sender_port = obj.get("from_port")
+
+        # پیام تست داخلی را نادیده بگیر
+        if msg == "__TEST_REPLY__":
+            if sender_port:
+                with self._peers_lock:
+                    self._remember_peer(ip, sender_port)
+                self.mark_peers_dirty()
+            try:
+                self._request_refresh()
+            except Exception:
+                logger.debug("Failed to refresh peers after TEST_REPLY")
+            return
 
-                # رفرش رابط کاربری
-                try:
-                    self.root.after(0, self.refresh_peers)
-                    self.root.after(0, lambda ip=ip, msg=msg: self.display_incoming(ip, msg))
-                except Exception:
-                    logger.warning("Failed to update UI after message from %s", ip)
+        # پیام واقعی: ذخیره و نمایش
+        try:
+            record_history(ip, "in", msg, entry_type="msg")
+        except Exception:
+            logger.warning("Failed to record incoming msg from %s", ip)
 
-            # ----------------- 4. Unknown -----------------
-            else:
-                logger.debug("Unknown object from %s: %s", ip, obj)
+        logger.info("Received message from %s", ip)
+        if sender_port:
+            with self._peers_lock:
+                self._remember_peer(ip, sender_port)
+            self.mark_peers_dirty()
 
-        except Exception as e:
-            logger.warning("handle_conn error for %s: %s", ip, e)
-        finally:
+        # رفرش رابط کاربری
+        try:
+            self._request_refresh()
+            self.root.after(0, lambda ip=ip, msg=msg: self.display_incoming(ip, msg))
+        except Exception:
+            logger.warning("Failed to update UI after message from %s", ip)
+
+    def mark_peers_dirty(self):
+        """اعلام تغییر در self.peers؛ نوشتن روی دیسک توسط peers_writer انجام می‌شود"""
+        self._peers_dirty.set()
+
+    def flush_peers(self):
+        """نوشتن یک کپی از وضعیت فعلی self.peers روی دیسک"""
+        # _peers_save_lock ترتیب نوشتن‌ها را حفظ می‌کند؛ _peers_lock فقط هنگام کپی گرفته می‌شود
+        with self._peers_save_lock:
+            with self._peers_lock:
+                snap = {ip: dict(info) for ip, info in self.peers.items()}
+            save_peers(snap)
+
+    def peers_writer(self):
+        """
+        thread ذخیره‌ی peers: بعد از هر تغییر PEERS_SAVE_DELAY ثانیه صبر می‌کند
+        تا تغییرات پشت سر هم (مثلاً پونگ همه‌ی همتایان) در یک نوشتن جمع شوند.
+        """
+        while not self._stop.is_set():
+            self._peers_dirty.wait()
+            # هنگام توقف، ذخیره‌ی نهایی در shutdown انجام می‌شود
+            if self._stop.wait(PEERS_SAVE_DELAY):
+                return
+            self._peers_dirty.clear()
             try:
-                conn.close()
+                self.flush_peers()
             except Exception:
-                pass
+                logger.exception("peers_writer failed")
+
+    def _mark_peer_seen(self, ip, port=None):
+        """
+        علامت‌گذاری همتا به عنوان آنلاین و ثبت زمان آخرین مشاهده.
+        اگر port داده شود و همتا ناشناخته باشد، به لیست اضافه می‌شود.
+        """
+        with self._peers_lock:
+            info = self.peers.get(ip)
+            if info is None:
+                if port is None:
+                    return
+                info = self._remember_peer(ip, port)
+                if info is None:
+                    return
+            info["online"] = True
+            info["last_seen"] = now()       # فقط برای نمایش و فایل peers
+            info["last_seen_ts"] = time.time()
+        self.mark_peers_dirty()
+
+    def _remember_peer(self, ip, port):
+        """
+        ثبت همتایی که خودش با ما تماس گرفته (فقط با _peers_lock صدا زده شود).
+        همتای موجود فقط port و وضعیتش به‌روز می‌شود؛ خود سیستم هرگز اضافه نمی‌شود و
+        اگر لیست به MAX_PEERS رسیده باشد، همتایی که دیرتر از همه دیده شده حذف می‌شود.
+        همتاهای اضافه‌شده توسط کاربر ("manual") و همتاهایی که پنجره چتشان باز است حذف نمی‌شوند؛
+        اگر همتای قابل حذفی نباشد، همتای جدید اضافه نمی‌شود.
+        خروجی: dict اطلاعات همتا یا None اگر اضافه نشد
+        """
+        peers = self.peers
+        info = peers.get(ip)
+        if info is not None:
+            info["port"] = port
+            info["online"] = True
+            return info
+        if ip == self.local_ip:
+            return None
+        if len(peers) >= MAX_PEERS:
+            candidates = [p for p, i in peers.items()
+                          if not i.get("manual") and p not in self.chat_windows]
+            if not candidates:
+                logger.warning("Peer list full; not adding %s", ip)
+                return None
+            stale = min(candidates, key=lambda p: peers[p].get("last_seen_ts") or 0)
+            del peers[stale]
+            self.new_msg_peers.discard(stale)
+            logger.info("Peer list full; dropped least recently seen peer %s", stale)
+        info = peers[ip] = {"port": port, "online": True}
+        return info
 
     def display_incoming(self, ip, msg):
         """
@@ -900,95 +2092,105 @@ class ChatApp:
         اگر پنجره چت برای آن IP باز نباشد، آیکون پیام جدید (⭐) فعال می‌شود.
         """
         # اگر همتا در لیست peers وجود نداشت، به عنوان آنلاین اضافه می‌شود
-        if ip not in self.peers:
-            self.peers[ip] = {"port": 0, "online": True}
+        with self._peers_lock:
+            if ip not in self.peers:
+                self._remember_peer(ip, 0)
 
         # اگر پنجره چت باز نباشد → نوتیف پیام جدید نمایش داده شود
         if ip not in self.chat_windows:
             self.new_msg_peers.add(ip)
-            self.refresh_peers()
-            self.play_notify_sound()
+            self._request_refresh()
+            self.play_notify_sound(ip)
             return  # چون پنجره باز نیست
 
         # اگر پنجره باز است → ستاره پیام جدید حذف می‌شود
         self.new_msg_peers.discard(ip)
-        self.refresh_peers()
+        self._request_refresh()
 
-        # گرفتن پنجره و ناحیه‌ی چت مربوط به IP
-        win, chat_area = self.chat_windows.get(ip, (None, None))
-        if not win or not chat_area:
+        # درج پیام دریافتی در سمت چپ (مثل تلگرام)
+        if not self.append_to_chat_window(ip, "you", msg):
             self.new_msg_peers.add(ip)
-            self.refresh_peers()
-            self.play_notify_sound()
+            self._request_refresh()
+            self.play_notify_sound(ip)
             return
 
-        # ساخت حباب پیام دریافتی در سمت چپ (مثل تلگرام)
-        frame = tk.Frame(chat_area, bg="#e7eefb")
-        frame.pack(fill="x", pady=3, anchor="w")
-
-        bubble = tk.Label(
-            frame,
-            text=msg,
-            bg="white",
-            fg="black",
-            font=("Segoe UI", 10),
-            wraplength=320,
-            justify="left",
-            padx=10,
-            pady=6,
-            relief="ridge",
-            bd=1
-        )
-        bubble.pack(anchor="w", padx=10, pady=2)
-
-        tk.Label(
-            frame,
-            text=now(),
-            bg="#e7eefb",
-            fg="#777",
-            font=("Segoe UI", 8)
-        ).pack(anchor="w", padx=15)
-
-        # اسکرول خودکار به پایین
-        chat_area.update_idletasks()
-        chat_area.master.yview_moveto(1)
-
         # پخش صدای اعلان (اختیاری)
-        self.play_notify_sound()
+        self.play_notify_sound(ip)
 
 
-    def append_to_chat_window(self, ip, who, msg_text):
+    def append_to_chat_window(self, ip, who, msg_text, t=None):
         """
         این تابع یک پیام را در پنجره چت مخصوص IP مشخص نمایش می‌دهد.
         - ip: آدرس همتا (Peer)
-        - who: فرستنده پیام ("You" یا IP طرف مقابل)
+        - who: فرستنده پیام ("me"، "you" یا "system"؛ همان tag ویجت Text)
         - msg_text: متن پیام
+        - t: زمان نمایش داده‌شده (پیش‌فرض: اکنون؛ برای "system" زمانی نمایش داده نمی‌شود)
+        اگر پنجره باز نباشد False برمی‌گرداند.
         """
         # گرفتن ویجت text مربوط به پنجره چت
         win_text = self.chat_windows.get(ip, (None, None))[1]
-        if not win_text:
+        if not win_text or not win_text.winfo_exists():
             # اگر پنجره باز نبود، هیچ کاری نمی‌کند
-            return
+            return False
 
         # تغییر وضعیت text به قابل ویرایش
-        win_text.config(state='normal')
-        # درج پیام جدید با timestamp
-        win_text.insert('end', f"[{now()}] {who}: {msg_text}\n")
+        win_text.config(state="normal")
+        if who == "you":
+            self._insert_incoming(ip, win_text, msg_text)
+        else:
+            if t is None and who != "system":
+                t = now()
+            self._insert_chat_line(win_text, who, msg_text, t)
         # دوباره غیرقابل ویرایش کردن text
-        win_text.config(state='disabled')
+        win_text.config(state="disabled")
         # اسکرول خودکار به آخرین پیام
-        win_text.see('end')
+        win_text.see("end")
+        return True
+
+    def _insert_incoming(self, ip, chat_area, msg):
+        """
+        درج پیام دریافتی؛ پیام‌های پشت سر هم یک همتا (در BUBBLE_COALESCE_SECONDS) زیر یک خط زمان جمع می‌شوند.
+        ویجت باید در وضعیت normal باشد.
+        """
+        t = time.monotonic()
+        last = self._last_bubble.get(ip)
+        if (last is not None and last[0] is chat_area and t - last[1] < BUBBLE_COALESCE_SECONDS
+                and chat_area.index("end-1c") == last[2]):
+            # پیام قبلی همین همتا لحظاتی پیش و آخرین متن پنجره بوده است:
+            # پیام جدید بعد از آن و پیش از خط زمان درج می‌شود (بدون خط زمان جدید)
+            chat_area.mark_gravity("incoming_tail", "right")
+            chat_area.insert("incoming_tail", msg + "\n", ("you",))
+            chat_area.mark_gravity("incoming_tail", "left")
+        else:
+            chat_area.insert("end", msg + "\n", ("you",))
+            # نشانه‌ی انتهای پیام (قبل از خط زمان) برای ادغام پیام‌های بعدی
+            chat_area.mark_set("incoming_tail", "end-1c")
+            chat_area.mark_gravity("incoming_tail", "left")
+            chat_area.insert("end", now() + "\n", ("you", "time"))
+        self._last_bubble[ip] = (chat_area, t, chat_area.index("end-1c"))
 
 
-    def play_notify_sound(self):
+    def play_notify_sound(self, ip=None):
         """
         یک صدای ساده هشدار برای پیام جدید پخش می‌کند.
         روی Windows از winsound استفاده می‌کند و روی سیستم‌های دیگر از بوق terminal.
+        برای هر همتا حداکثر یک صدا در هر NOTIFY_SOUND_MIN_INTERVAL ثانیه پخش می‌شود.
         """
-        if platform.system() == "Windows":
-            winsound.MessageBeep(winsound.MB_ICONASTERISK)
-        else:
-            os.system('echo -n "\\a"')  # basic beep
+        if not self._notify_enabled:
+            return
+        t = time.monotonic()
+        if t - self._last_sound.get(ip, 0.0) < NOTIFY_SOUND_MIN_INTERVAL:
+            return
+        self._last_sound[ip] = t
+        try:
+            if _IS_WINDOWS:
+                winsound.MessageBeep(winsound.MB_ICONASTERISK)
+            else:
+                # نوشتن مستقیم کاراکتر bell؛ بدون اجرای shell جدید برای هر پیام
+                sys.stdout.write("\a")
+                sys.stdout.flush()
+        except Exception:
+            logger.debug("Failed to play notification sound", exc_info=True)
 
 
     def send_message(self, ip, port, msg):
@@ -1001,107 +2203,287 @@ class ChatApp:
             except Exception:
                 logger.warning("send_message: port is not int for %s: %r", ip, port)
 
-            logger.debug("send_message -> attempting connect to %s:%s (from listen port %s) msg=%s", ip, port, self.listen_port, msg if len(msg)<100 else msg[:100]+"...")
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(4)  # timeout for connect/send
-            s.connect((ip, port))  #هیچ محدودیتی روی IP وجود نداره.
-
-
-            payload = {"msg": msg, "from_port": self.listen_port}
-            s.send(pack_payload(payload))
-            # give remote a moment (optional) then close
-            try:
-                s.shutdown(socket.SHUT_WR)
-            except Exception:
-                pass
-            s.close()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("send_message -> sending to %s:%s (from listen port %s) msg=%s", ip, port, self.listen_port, msg if len(msg)<100 else msg[:100]+"...")
+            payload = {"t": "msg", "msg": msg, "from_port": self.listen_port}
+            self.send_pooled(ip, port, pack_payload(payload))
             logger.debug("send_message -> sent to %s:%s", ip, port)
             return True
         except Exception:
             logger.exception("send_message failed to %s:%s", ip, port)
             return False
 
+    def _get_conn(self, ip, port, connect_timeout=4):
+        """
+        گرفتن اتصال باز به همتا از pool یا ساخت اتصال جدید.
+        خروجی: (entry, reused) که reused نشان می‌دهد اتصال از قبل باز بوده است.
+        """
+        key = (ip, port)
+        with self._conn_pool_lock:
+            entry = self._conn_pool.get(key)
+        if entry is not None:
+            if _conn_alive(entry["sock"]):
+                return entry, True
+            self._drop_conn(key, entry)
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_tcp_socket(s)
+        s.settimeout(connect_timeout)
+        try:
+            s.connect((ip, port))  #هیچ محدودیتی روی IP وجود نداره.
+        except Exception:
+            s.close()
+            raise
+        s.settimeout(4)  # timeout for send
+        entry = {"sock": s, "lock": threading.Lock(), "used": time.monotonic()}
+        with self._conn_pool_lock:
+            other = self._conn_pool.get(key)
+            if other is not None:
+                # thread دیگری هم‌زمان اتصال ساخته است؛ از همان استفاده می‌شود
+                s.close()
+                return other, True
+            self._conn_pool[key] = entry
+        return entry, False
+
+    def _drop_conn(self, key, entry):
+        """حذف یک اتصال از pool و بستن آن"""
+        with self._conn_pool_lock:
+            if self._conn_pool.get(key) is entry:
+                del self._conn_pool[key]
+        try:
+            entry["sock"].close()
+        except Exception:
+            pass
+
+    def send_pooled(self, ip, port, payload):
+        """
+        ارسال یک فریم روی اتصال باز به همتا.
+        اگر اتصال قدیمی قطع شده باشد، یک بار با اتصال تازه دوباره تلاش می‌شود.
+        """
+        # فریم پیش از گرفتن قفل اتصال ساخته می‌شود تا داخل قفل فقط sendall انجام شود
+        frame = make_frame(payload)
+        while True:
+            entry, reused = self._get_conn(ip, port)
+            try:
+                with entry["lock"]:
+                    entry["sock"].sendall(frame)
+                    entry["used"] = time.monotonic()
+                return
+            except OSError:
+                self._drop_conn((ip, port), entry)
+                if not reused:
+                    raise
+                logger.debug("Pooled connection to %s:%s was stale, reconnecting", ip, port)
+
+    def reap_idle_connections(self):
+        """بستن دوره‌ای اتصال‌های خروجی که بیش از PEER_CONN_IDLE_TIMEOUT بیکار مانده‌اند"""
+        while not self._stop.wait(PEER_CONN_IDLE_TIMEOUT / 2):
+            cutoff = time.monotonic() - PEER_CONN_IDLE_TIMEOUT
+            with self._conn_pool_lock:
+                idle = [(k, e) for k, e in self._conn_pool.items() if e["used"] < cutoff]
+            for key, entry in idle:
+                logger.debug("Closing idle connection to %s:%s", *key)
+                self._drop_conn(key, entry)
+
     def check_peers_online(self):
         """
         یک حلقه دائمی برای بررسی وضعیت آنلاین بودن همتاها.
-        هر چند ثانیه (CHECK_INTERVAL) همه‌ی IPها ping می‌شوند.
+        هر چند ثانیه (CHECK_INTERVAL) همه‌ی IPها ping می‌شوند؛
+        با set کردن _force_check دور بعدی فوراً شروع می‌شود و با _stop حلقه تمام می‌شود.
         """
-        while True:
-            for ip, info in list(self.peers.items()):
-                last_seen = info.get("last_seen")
-                if last_seen:
-                    try:
-                        t = datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S")
-                        if (datetime.now() - t).seconds > 60:
-                            continue  # بیشتر از ۱ دقیقه از آخرین تماس گذشته، فعلاً پینگ نکن
-                    except:
-                        pass
-                ok = self.ping_peer(ip, info["port"])
-                info["online"] = ok
+        while not self._stop.is_set():
+            targets = []
+            now_ts = time.time()
+            with self._peers_lock:
+                for ip, info in self.peers.items():
+                    ts = info.get("last_seen_ts")
+                    if ts is None and info.get("last_seen"):
+                        # peers ذخیره‌شده با نسخه‌های قبلی فقط رشته دارند؛ یک بار تبدیل و نگه‌داری می‌شود
+                        try:
+                            # قالب "%Y-%m-%d %H:%M:%S" را fromisoformat مستقیم (و سریع‌تر از strptime) می‌خواند
+                            ts = info["last_seen_ts"] = datetime.fromisoformat(info["last_seen"]).timestamp()
+                        except (TypeError, ValueError):
+                            pass
+                    if ts is not None and now_ts - ts > 60:
+                        continue  # بیشتر از ۱ دقیقه از آخرین تماس گذشته، فعلاً پینگ نکن
+                    targets.append((ip, info, info["port"]))
+
+            # اول همه با یک دور پینگ UDP بررسی می‌شوند؛ فقط بی‌پاسخ‌ها با TCP پینگ می‌شوند
+            answered = self.udp_ping_round([(ip, port) for ip, _, port in targets])
+            missing = []
+            with self._peers_lock:
+                for ip, info, port in targets:
+                    if ip in answered:
+                        info["online"] = True
+                        info["last_seen"] = now()
+                        info["last_seen_ts"] = time.time()
+                    else:
+                        missing.append((ip, info, port))
 
-            # بعد از بررسی همه همتاها، UI لیست کاربران را رفرش می‌کند
-            self.refresh_peers()
+            # پینگ‌های TCP هم‌زمان انجام می‌شوند تا همتاهای خاموش (هر کدام تا TCP_PING_TIMEOUT ثانیه) دور را طولانی نکنند
+            if missing:
+                try:
+                    futs = {self._ping_pool.submit(self.ping_peer, ip, port): info
+                            for ip, info, port in missing}
+                except RuntimeError:
+                    break  # pool در shutdown بسته شده است
+                try:
+                    for fut in as_completed(futs, timeout=CHECK_INTERVAL):
+                        try:
+                            online = bool(fut.result())
+                        except Exception as e:
+                            logger.debug("TCP ping failed: %s", e)
+                            online = False
+                        with self._peers_lock:
+                            futs[fut]["online"] = online
+                except FuturesTimeoutError:
+                    # پینگ‌های جامانده در دور بعد دوباره بررسی می‌شوند؛ نتایج رسیده حفظ می‌شوند
+                    logger.debug("TCP ping round timed out; keeping partial results")
 
-            # تاخیر بین چک‌ها
-            time.sleep(CHECK_INTERVAL)
+            # بعد از بررسی همه همتاها، UI لیست کاربران یک بار (در thread رابط کاربری) رفرش می‌شود
+            self._request_refresh()
 
+            # تاخیر بین چک‌ها (یا تا درخواست بررسی فوری)
+            self._force_check.wait(CHECK_INTERVAL)
+            self._force_check.clear()
 
-    def ping_peer(self, ip, port):
+
+    def udp_ping_round(self, targets):
         """
-        ارسال پینگ {"ping":1} به همتا و انتظار برای پاسخ {"pong":1, "rtt_ms":...}.
-        پینگ/پونگ هرگز در UI چت نمایش داده نمی‌شوند؛ فقط به عنوان entry_type="ping" در تاریخچه ذخیره می‌شوند.
+        ارسال پینگ UDP به همه‌ی همتایان با یک سوکت و جمع‌آوری پاسخ‌ها تا UDP_PING_TIMEOUT.
+        - targets: لیست (ip, port)
+        خروجی: مجموعه‌ی IP هایی که پونگ فرستاده‌اند.
         """
+        answered = set()
+        if not targets:
+            return answered
+        expected = {ip for ip, _ in targets}
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(3)  # زمان مجاز برای پاسخ
-            start = time.time()
-
-            # اتصال به همتا
-            s.connect((ip, port))
+            s.setblocking(False)
+            ping = make_ping()
+            for ip, port in targets:
+                try:
+                    s.sendto(ping, (ip, port))
+                except OSError as e:
+                    logger.debug("UDP ping to %s:%s failed: %s", ip, port, e)
+
+            deadline = time.monotonic() + UDP_PING_TIMEOUT
+            while answered != expected:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([s], [], [], remaining)
+                if not readable:
+                    break
+                try:
+                    data, addr = s.recvfrom(65535)
+                except Exception:
+                    continue    # مثلاً پاسخ ICMP "port unreachable" در ویندوز
+                if addr[0] in expected and pong_rtt_ms(data) is not None:
+                    answered.add(addr[0])
+        finally:
+            s.close()
+        return answered
 
-            # ارسال پیام پینگ
-            s.send(pack_payload({"ping": 1}))
+    @staticmethod
+    def _connect_local(port):
+        """اتصال به Unix socket برنامه‌ی محلی روی این پورت؛ اگر در دسترس نباشد None (برگشت به TCP)"""
+        path = unix_socket_path(port)
+        if not path or not os.path.exists(path):
+            return None
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(3)
+        try:
+            s.connect(path)
+            return s
+        except OSError:
+            s.close()
+            return None
 
-            # اطلاع دادن به سیستم مقصد که دیگر داده‌ای ارسال نمی‌شود
+    def _ping_pooled(self, ip, port):
+        """
+        ارسال پینگ باینری روی اتصال pool و خواندن پونگ از همان اتصال (گیرنده پونگ را روی همان اتصال می‌فرستد).
+        اگر پاسخ معتبر نرسد اتصال کنار گذاشته می‌شود تا پونگ دیررسیده پاسخ پینگ بعدی حساب نشود؛
+        اتصال قدیمی قطع‌شده یک بار با اتصال تازه دوباره امتحان می‌شود.
+        خروجی: فریم پونگ (در صورت خطا OSError)
+        """
+        while True:
+            entry, reused = self._get_conn(ip, port, connect_timeout=TCP_PING_TIMEOUT)
             try:
-                s.shutdown(socket.SHUT_WR)
-            except Exception:
-                pass
+                with entry["lock"]:
+                    sock = entry["sock"]
+                    sock.settimeout(TCP_PING_TIMEOUT)
+                    try:
+                        sock.sendall(make_ping_frame())
+                        # پونگ بدون تأخیر ACK تأیید می‌شود
+                        if hasattr(socket, "TCP_QUICKACK"):
+                            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                        data = recv_frame(sock)
+                    finally:
+                        sock.settimeout(4)
+                    if data is None or pong_rtt_ms(data) is None:
+                        raise ConnectionError("no valid pong")
+                    entry["used"] = time.monotonic()
+                return data
+            except OSError:
+                self._drop_conn((ip, port), entry)
+                if not reused:
+                    raise
+                logger.debug("Pooled connection to %s:%s was stale, reconnecting", ip, port)
 
-            # دریافت پاسخ پونگ (یا خالی)
-            data = b""
-            try:
-                data = s.recv(8192)
-            except Exception:
-                pass
+    def ping_peer(self, ip, port):
+        """
+        ارسال پینگ باینری به همتا و انتظار برای پونگ باینری (زمان پینگ برگردانده می‌شود).
+        پینگ/پونگ هرگز در UI چت نمایش داده نمی‌شوند.
+        """
+        try:
+            s = self._connect_local(port) if ip in _LOOPBACK_HOSTS else None
+            if s is None:
+                # همتای شبکه: پینگ روی اتصال نگه‌داشته‌شده در pool (بدون handshake برای هر پینگ)
+                data = self._ping_pooled(ip, port)
+            else:
+                with s:
+                    # ارسال پیام پینگ
+                    s.sendall(make_ping_frame())
 
-            # بازکردن بسته پونگ دریافتی
-            try:
-                obj = unpack_payload(data) if data else {}
-            except Exception as e:
-                logger.exception("Failed to unpack pong from %s: %s", ip, e)
-                s.close()
-                return False
+                    # اطلاع دادن به سیستم مقصد که دیگر داده‌ای ارسال نمی‌شود
+                    try:
+                        s.shutdown(socket.SHUT_WR)
+                    except Exception:
+                        pass
 
-            s.close()
+                    # دریافت فریم پاسخ پونگ (یا خالی)؛ recv_frame تا کامل شدن فریم می‌خواند
+                    data = b""
+                    try:
+                        data = recv_frame(s) or b""
+                    except Exception:
+                        pass
 
-            # محاسبه‌ی زمان رفت و برگشت پینگ به میلی‌ثانیه
-            elapsed_ms = int((time.time() - start) * 1000)
+            # زمان رفت و برگشت از زمان برگردانده‌شده در پونگ محاسبه می‌شود
+            rtt_val = pong_rtt_ms(data)
 
             # اگر پاسخ معتبر پونگ بود
-            if isinstance(obj, dict) and obj.get("pong"):
-                rtt_val = obj.get("rtt_ms", elapsed_ms)
+            if rtt_val is not None:
                 # فقط وضعیت آنلاین را به‌روزرسانی کن، بدون ذخیره در history
-                if ip in self.peers:
-                    self.peers[ip]["online"] = True
-                    self.peers[ip]["last_seen"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_peers(self.peers)
+                self._mark_peer_seen(ip)
                 logger.debug("Ping to %s success %d ms", ip, rtt_val)
                 return True
 
 
-        except Exception:
-            logger.exception("ping_peer failed for %s:%s", ip, port)
+        except OSError as e:
+            # همتای خاموش یا غیرقابل دسترس حالت عادی است؛ بدون ساخت traceback
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("ping_peer failed for %s:%s: %r", ip, port, e)
+            return False
+        except Exception as e:
+            # خطای غیرمنتظره با traceback ثبت می‌شود، ولی حداکثر یک بار در هر ۵ ثانیه (پینگ‌ها هم‌زمان و پرتعدادند)
+            t = time.monotonic()
+            if t - self._last_ping_err_log > 5:
+                self._last_ping_err_log = t
+                logger.exception("ping_peer failed for %s:%s", ip, port)
+            else:
+                logger.debug("ping_peer failed for %s:%s: %r", ip, port, e)
             return False
 
 
@@ -1117,7 +2499,8 @@ class ChatApp:
             "Keep last N",
             "Keep last N messages per peer (N):",
             minvalue=1,
-            initialvalue=100
+            initialvalue=100,
+            parent=self.root
         )
         if ans is None:
             return  # اگر کاربر انصراف داد، هیچ کاری انجام نمی‌شود
@@ -1133,28 +2516,61 @@ class ChatApp:
             "Keep last X days",
             "Keep messages from last X days (per peer):",
             minvalue=1,
-            initialvalue=30
+            initialvalue=30,
+            parent=self.root
         )
         if ans is None:
             return
         self.keep_last_days(ans)
 
 
+    def _run_history_task(self, name, work, done_msg, error_msg):
+        """
+        اجرای یک عملیات روی تاریخچه در thread جدا تا رابط کاربری منتظر قفل‌ها و نوشتن فایل نماند؛
+        نتیجه با root.after در thread رابط کاربری نمایش داده می‌شود؛
+        اگر work متنی برگرداند، همان متن به جای done_msg نمایش داده می‌شود.
+        تا تمام شدن عملیات قبلی، عملیات جدید شروع نمی‌شود.
+        """
+        if not self._history_task_lock.acquire(blocking=False):
+            messagebox.showinfo("Busy", "Another history operation is still running.", parent=self.root)
+            return
+
+        def run():
+            try:
+                result = work()
+            except Exception:
+                logger.exception("%s failed", name)
+                self.root.after(0, lambda: messagebox.showerror("Error", error_msg, parent=self.root))
+                return
+            finally:
+                self._history_task_lock.release()
+            msg = result or done_msg
+            self.root.after(0, lambda: messagebox.showinfo("Done", msg, parent=self.root))
+
+        try:
+            threading.Thread(target=run, name=name, daemon=True).start()
+        except Exception:
+            self._history_task_lock.release()
+            raise
+
+
     def clear_history(self):
         """
         حذف کامل تاریخچه پیام‌ها برای همه‌ی همتاها.
         قبل از حذف، از کاربر تایید گرفته می‌شود.
         """
-        if messagebox.askyesno("Clear History", "Are you sure? This will delete all stored history."):
-            try:
-                with history_lock:  # قفل‌گذاری برای جلوگیری از دسترسی همزمان
-                    history.clear()  # پاک کردن کل تاریخچه از حافظه
-                    save_history(history)  # ذخیره تغییرات در فایل
-                messagebox.showinfo("Done", "History cleared.")
-                logger.info("User cleared all history")
-            except Exception:
-                logger.exception("Failed to clear history")
-                messagebox.showerror("Error", "Failed to clear history. Check logs.")
+        if not messagebox.askyesno("Clear History", "Are you sure? This will delete all stored history.", parent=self.root):
+            return
+
+        def work():
+            with history_exclusive():  # قفل‌گذاری برای جلوگیری از دسترسی همزمان
+                history.clear()  # پاک کردن کل تاریخچه از حافظه
+                # snapshot خالی نوشته و journal با truncate خالی می‌شود (هزینه ثابت، بدون tombstone)
+                save_history(history)
+            logger.info("User cleared all history")
+
+        self._run_history_task("clear_history", work, "History cleared.",
+                               "Failed to clear history. Check logs.")
 
 
     def keep_last_n(self, n):
@@ -1162,18 +2578,7 @@ class ChatApp:
         فقط N پیام آخر (پیام + پینگ) را برای هر همتا نگه می‌دارد.
         در صورت زیاد بودن، بقیه پیام‌ها حذف می‌شوند.
         """
-        try:
-            with history_lock:
-                for peer, lst in list(history.items()):
-                    if len(lst) > n:
-                        # فقط N پیام آخر نگه داشته می‌شود
-                        history[peer] = lst[-n:]
-                save_history(history)
-            messagebox.showinfo("Done", f"Kept last {n} messages per peer.")
-            logger.info("Compressed history to last %d per peer", n)
-        except Exception:
-            logger.exception("keep_last_n failed")
-            messagebox.showerror("Error", "Failed to compress history. Check logs.")
+        self.compact(n=n)
 
 
     def keep_last_days(self, days):
@@ -1181,29 +2586,46 @@ class ChatApp:
         فقط پیام‌های X روز اخیر را برای هر همتا نگه می‌دارد.
         پیام‌های قدیمی‌تر از cutoff حذف می‌شوند.
         """
-        try:
-            cutoff = datetime.now() - timedelta(days=days)
-            with history_lock:
-                for peer, lst in list(history.items()):
-                    new_lst = []
-                    for entry in lst:
-                        try:
-                            # تبدیل زمان پیام به آبجکت datetime
-                            t = datetime.strptime(entry.get("time"), "%Y-%m-%d %H:%M:%S")
-                        except Exception:
-                            # پیام‌هایی که زمان معتبری ندارند، حذف می‌شوند
-                            continue
-                        if t >= cutoff:
-                            new_lst.append(entry)
-                    history[peer] = new_lst
-                save_history(history)
+        self.compact(days=days)
 
-            messagebox.showinfo("Done", f"Kept messages from last {days} days.")
-            logger.info("Compressed history to last %d days", days)
 
-        except Exception:
-            logger.exception("keep_last_days failed")
-            messagebox.showerror("Error", "Failed to compress history. Check logs.")
+    def compact(self, n=None, days=None):
+        """
+        حذف پیام‌های قدیمی هر همتا با یک یا هر دو شرط، در یک پیمایش:
+        - n: فقط N پیام آخر نگه داشته می‌شود
+        - days: فقط پیام‌های X روز اخیر نگه داشته می‌شوند (پیام‌های بدون زمان هم حذف می‌شوند)
+        """
+        if n is None and days is None:
+            return
+        if (n is not None and n < 1) or (days is not None and days < 1):
+            raise ValueError("n and days must be at least 1")
+        kept = []
+        if n is not None:
+            kept.append(f"last {n} messages per peer")
+        if days is not None:
+            kept.append(f"messages from last {days} days")
+        desc = " and ".join(kept)
+
+        def work():
+            # فقط خود عملیات در journal ثبت می‌شود؛ snapshot بعداً در فشرده‌سازی journal بازنویسی می‌شود
+            op = {"op": "keep"}
+            if n is not None:
+                op["n"] = n
+            if days is not None:
+                # زمان مرجع حذف به صورت رشته؛ قالب "%Y-%m-%d %H:%M:%S" به ترتیب زمانی قابل مقایسه‌ی رشته‌ای است
+                op["cutoff"] = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+            with history_exclusive():
+                removed = apply_history_op(history, op)
+                # اگر چیزی حذف نشده باشد، نوشتنی روی دیسک لازم نیست
+                if removed:
+                    _journal_append_op(op, removed)
+            if not removed:
+                return "No changes needed."
+            flush_history_journal()
+            logger.info("Compressed history to %s (%d records removed)", desc, removed)
+
+        self._run_history_task("compact_history", work, f"Kept {desc}.",
+                               "Failed to compress history. Check logs.")
 
 
     def prompt_set_shared_key(self):
@@ -1212,28 +2634,31 @@ class ChatApp:
         اگر کلید تعیین شود، ارتباطات رمزگذاری XOR+HMAC می‌شوند.
         اگر خالی باشد، ارتباطات به صورت متن ساده JSON رد و بدل می‌شود.
         """
-        global SHARED_KEY
         cur = SHARED_KEY or "<not set>"  # نمایش وضعیت فعلی کلید
 
         ans = simpledialog.askstring(
             "Shared Key",
-            f"Current key: {cur}\nEnter new shared key (empty to disable):"
+            f"Current key: {cur}\nEnter new shared key (empty to disable):",
+            parent=self.root
         )
         if ans is None:
             return  # اگر کاربر انصراف داد، کاری انجام نمی‌شود
 
-        SHARED_KEY = ans.strip()
+        set_shared_key(ans.strip())
+        self._force_check.set()     # وضعیت همتایان با کلید جدید فوراً بررسی شود
         if SHARED_KEY:
             logger.warning("Shared key enabled - using simple XOR+HMAC (NOT TLS).")
             messagebox.showinfo(
                 "Shared Key",
-                "Shared key set. Note: This uses a simple XOR+HMAC scheme (not TLS)."
+                "Shared key set. Note: This uses a simple XOR+HMAC scheme (not TLS).",
+                parent=self.root
             )
         else:
             logger.info("Shared key disabled by user.")
             messagebox.showinfo(
                 "Shared Key",
-                "Shared key disabled. Communications will be plain JSON."
+                "Shared key disabled. Communications will be plain JSON.",
+                parent=self.root
             )
 
 